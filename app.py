@@ -1,9 +1,11 @@
 from src import config
-from flask import Flask, request, make_response, render_template, send_from_directory
+from flask import Flask, request, make_response, render_template
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import text
-from src import file_upload, auth, view_count, helpers, videos
-from src.config import SITE_NAME, BASE_URL, VIDEO_FOLDER, IS_DEV
+import click
+import time
+from src import file_upload, auth, password_hashing, metrics, view_count, helpers, videos, transcode_queue, worker, video_metadata, thumbnails, video_data, migrations, comments, cleanup
+from src.config import SITE_NAME, BASE_URL, IS_DEV
 
 
 app = Flask(SITE_NAME)
@@ -17,9 +19,100 @@ auth.db = db
 file_upload.db = db
 view_count.db = db
 videos.db = db
+video_metadata.db = db
+migrations.db = db
+comments.db = db
+cleanup.db = db
 
 
 app.register_blueprint(videos.blueprint)
+app.register_blueprint(thumbnails.blueprint)
+
+metrics.init_app(app)
+
+
+if IS_DEV:
+    # there is no redis in dev environment, so the transcode worker runs inside the web server
+    worker.start(app)
+
+
+@app.cli.command("worker")
+def run_worker():
+    """Run the transcode worker, taking jobs from the transcode queue."""
+    worker.run(app)
+
+
+@app.cli.command("cleanup")
+@click.option("--dry-run", is_flag=True, help="Only report what would be removed.")
+def run_cleanup(dry_run: bool):
+    """Remove deleted video folders, whatever failed uploads and transcodes left behind, expired tokens and unused anonymous users."""
+    freed = 0 if dry_run else cleanup.purge_deleted_folders()
+    report = cleanup.reconcile(dry_run)
+    click.echo(f"Deleted videos: {freed} bytes")
+    click.echo(f"Orphan folders: {report['orphan_folders']} ({report['orphan_bytes']} bytes)")
+    click.echo(f"Stale uploads: {report['stale_uploads']}, stale transcode progress: {report['stale_progress']}")
+    click.echo(f"{'Would reclaim' if dry_run else 'Reclaimed'} {freed + report['orphan_bytes']} bytes")
+    if not dry_run:
+        reaped = cleanup.reap_expired()
+        click.echo(f"Expired tokens: {reaped['tokens']}, anonymous users: {reaped['users']}")
+
+
+@app.cli.command("migrate")
+def migrate():
+    """Apply the migrations in the migrations folder that haven't been applied yet."""
+    migrated = migrations.migrate()
+    for file_name in migrated:
+        click.echo(f"Applied {file_name}")
+    if not migrated:
+        click.echo("Database is up to date")
+
+
+@app.cli.command("check-indexes")
+def check_indexes():
+    """Fail if any query ran on every request falls back to a sequential scan."""
+    failed = False
+    for name, scans in migrations.check_indexes().items():
+        if scans:
+            failed = True
+            click.echo(f"FAIL {name}: sequential scan on {', '.join(scans)}")
+        else:
+            click.echo(f"ok   {name}")
+    if failed:
+        raise SystemExit(1)
+
+
+@app.cli.command("benchmark-auth")
+@click.option("--requests", default=10000, help="How many times the session is loaded in each case.")
+def benchmark_auth(requests: int):
+    """Measure the time requires_auth spends loading a session, for each session format."""
+    if not IS_DEV:
+        # the listener empties the user cache when it subscribes, so it's started first
+        auth.start_listener()
+        auth.listening.wait(5)
+    # a user that's only in this worker's cache, so the database isn't part of the measurement
+    user = auth.User(0, auth.UserType.anonymous, "benchmark")
+    auth.cache_user(user, 0)
+    stored = auth.create_stored_session(user).session_token
+    signed = auth.create_signed_session(user).session_token
+
+    cases = {
+        "stored, cached": lambda: auth.load_session(stored),
+        "stored, not cached": lambda: (auth.sessions.pop(stored), auth.load_session(stored)),
+        "signed, epoch cached": lambda: auth.load_session(signed),
+        "signed, epoch not cached": lambda: (auth.epochs.pop(user.uid), auth.load_session(signed))
+    }
+    for name, load in cases.items():
+        start = time.perf_counter()
+        for _ in range(requests):
+            load()
+        click.echo(f"{name:<26}{(time.perf_counter() - start) / requests * 1e6:8.1f} µs per request")
+
+    auth.revoke_session(user, stored)
+
+
+@app.errorhandler(password_hashing.Busy)
+def password_hashing_busy(e: password_hashing.Busy):
+    return helpers.create_error(str(e)), 429, { "Retry-After": str(e.retry_after) }
 
 
 @app.route("/")
@@ -49,7 +142,7 @@ def get_session():
         body["refresh"] = session.refresh
 
     response = make_response(body)
-    response.set_cookie("session", session.session_token, secure=not IS_DEV, httponly=True, samesite="Strict")
+    auth.set_session_cookie(response, session.session_token)
     return response
 
 
@@ -82,29 +175,72 @@ def signup():
 @app.route("/api/logout", methods=["POST"])
 @auth.requires_auth()
 def logout(user: auth.User):
-    return auth.logout(user, request.headers.get("Authorization"))
+    response = make_response(auth.logout(user, request.headers.get("Authorization"), request.cookies.get("session")))
+    response.delete_cookie("session", secure=not IS_DEV, httponly=True, samesite="Strict")
+    return response
 
 
 @app.route("/api/upload", methods=["POST"])
-@auth.requires_auth()
+@auth.requires_auth(persistent=True)
 def upload(user: auth.User):
     return file_upload.handle_upload(user.uid)
 
 
+@app.route("/api/upload/init", methods=["POST"])
+@auth.requires_auth(persistent=True)
+@helpers.requires_form_data({ "filename": str, "size": int })
+def upload_init(user: auth.User):
+    return file_upload.init_upload(user.uid)
+
+
+@app.route("/api/upload/<video_id>")
+@auth.requires_auth(persistent=True)
+def upload_status(user: auth.User, video_id: str):
+    return file_upload.upload_status(user.uid, video_id)
+
+
+@app.route("/api/upload/<video_id>", methods=["PUT"])
+@auth.requires_auth(persistent=True)
+def upload_chunk(user: auth.User, video_id: str):
+    return file_upload.write_chunk(user.uid, video_id)
+
+
+@app.route("/api/upload/<video_id>/finalize", methods=["POST"])
+@auth.requires_auth(persistent=True)
+def upload_finalize(user: auth.User, video_id: str):
+    return file_upload.finalize_upload(user.uid, video_id)
+
+
 @app.route("/api/progress/<video_id>")
 def progress(video_id):
     return file_upload.get_transcode_progress(video_id)
 
 
+@app.route("/api/progress/<video_id>/events")
+@metrics.streaming
+def progress_events(video_id):
+    return file_upload.stream_transcode_progress(video_id)
+
+
+@app.route("/api/transcode/queue")
+def transcode_queue_depth():
+    return transcode_queue.queue_depth()
+
+
+@app.route("/api/internal/stats")
+@helpers.requires_local()
+def internal_stats():
+    return { "session_cache": auth.sessions.stats(), "user_cache": auth.user_cache_stats() }
+
+
 @app.route("/video_data/<path:filename>")
-def video_data(filename):
-    return send_from_directory(VIDEO_FOLDER, filename)
+def serve_video_data(filename):
+    return video_data.serve(filename)
 
 
 @app.route("/v/<video_id>")
 def video_player(video_id: str):
-    sql = text("SELECT id, views, duration, title FROM videos WHERE id=:id")
-    video = db.session.execute(sql, { "id": video_id }).mappings().fetchone()
+    video = db.session.execute(text(videos.PLAYER_SQL), { "id": video_id }).mappings().fetchone()
     if not video:
         return "Not Found", 404
 
@@ -114,8 +250,12 @@ def video_player(video_id: str):
                            header_title=SITE_NAME,
                            title=video["title"],
                            views=video["views"],
-                           video_url=f"{BASE_URL}/video_data/{video_id}/compressed.mp4",
-                           thumbnail_url=f"{BASE_URL}/video_data/{video_id}/thumbnail.png")
+                           # size from the metadata saved at upload, so the page doesn't jump around while the video loads
+                           width=video["height"] if video["rotation"] in (90, 270) else video["width"],
+                           height=video["width"] if video["rotation"] in (90, 270) else video["height"],
+                           video_url=f"{BASE_URL}/video_data/{video['folder']}/{file_upload.video_source(video['folder'])}",
+                           thumbnail_url=f"{BASE_URL}/video_data/{video['folder']}/thumbnail.png",
+                           poster_url=f"{BASE_URL}/thumbnail/{video['folder']}")
 
 
 @app.route("/v/<video_id>/view")
@@ -124,10 +264,3 @@ def video_view(user: auth.User, video_id: str):
     view_count.process_view(video_id, user)
     return "OK"
 
-
-@app.route("/api/setprogress/<video_id>", methods=["POST"])
-# this route is only accessible to localhost, for ffmpeg to report back transcode progress
-def set_progress(video_id):
-    if request.remote_addr not in ["127.0.0.1", "::1"] or "X-Proxied-For" in request.headers:
-        return "Forbidden", 403
-    return file_upload.set_transcode_progress(video_id)
@@ -0,0 +1,31 @@
+-- brings a database created from an older schema.sql up to date with the tables and columns added since,
+-- databases created from the current schema.sql already have all of this
+CREATE TABLE IF NOT EXISTS public.video_assets (
+    hash text NOT NULL,
+    folder text NOT NULL,
+    refcount integer DEFAULT 1 NOT NULL,
+    CONSTRAINT video_assets_pkey PRIMARY KEY (hash)
+);
+
+CREATE TABLE IF NOT EXISTS public.video_metadata (
+    video_id text NOT NULL,
+    width integer NOT NULL,
+    height integer NOT NULL,
+    frame_rate real,
+    duration real NOT NULL,
+    bitrate integer,
+    rotation integer DEFAULT 0 NOT NULL,
+    video_codec text,
+    audio_codec text,
+    streams jsonb NOT NULL,
+    CONSTRAINT video_metadata_pkey PRIMARY KEY (video_id),
+    CONSTRAINT video_metadata_video_id_fkey FOREIGN KEY (video_id) REFERENCES public.videos(id)
+);
+
+-- videos uploaded before files could be shared are in a folder named after the video
+ALTER TABLE public.videos ADD COLUMN IF NOT EXISTS folder text;
+UPDATE public.videos SET folder=id WHERE folder IS NULL;
+ALTER TABLE public.videos ALTER COLUMN folder SET NOT NULL;
+
+ALTER TABLE public.videos ADD COLUMN IF NOT EXISTS content_hash text
+    CONSTRAINT videos_content_hash_fkey REFERENCES public.video_assets(hash);
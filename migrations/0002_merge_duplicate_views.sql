@@ -0,0 +1,11 @@
+-- views are upserted on (video_id, user_id), merge rows duplicated before that had a unique constraint,
+-- count is the number of views after the first, so each extra row adds its count and its own first view.
+-- both statements run in one transaction, so an interrupted merge is rolled back rather than counted twice when ran again
+-- (min(ctid) needs postgres 14 or newer)
+UPDATE public.views V SET count=D.count
+FROM (SELECT video_id, user_id, min(ctid) AS keep, sum(count) + count(*) - 1 AS count FROM public.views
+      GROUP BY video_id, user_id HAVING count(*) > 1) AS D
+WHERE V.ctid=D.keep;
+
+DELETE FROM public.views V USING public.views W
+WHERE V.video_id=W.video_id AND V.user_id=W.user_id AND V.ctid > W.ctid;
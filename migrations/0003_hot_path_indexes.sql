@@ -0,0 +1,28 @@
+-- no transaction
+-- indexes for the lookups done on every request, built without locking the tables against writes.
+-- if building one fails it's left invalid, so each is dropped first to make running this again rebuild it
+-- (duplicate views the unique index on views would fail on are merged by 0002 before this)
+
+ALTER TABLE public.views DROP CONSTRAINT IF EXISTS views_video_id_user_id_key;
+DROP INDEX CONCURRENTLY IF EXISTS public.views_video_id_user_id_key;
+CREATE UNIQUE INDEX CONCURRENTLY views_video_id_user_id_key ON public.views USING btree (video_id, user_id);
+ALTER TABLE public.views ADD CONSTRAINT views_video_id_user_id_key UNIQUE USING INDEX views_video_id_user_id_key;
+
+ALTER TABLE public.tokens DROP CONSTRAINT IF EXISTS tokens_token_key;
+DROP INDEX CONCURRENTLY IF EXISTS public.tokens_token_key;
+CREATE UNIQUE INDEX CONCURRENTLY tokens_token_key ON public.tokens USING btree (token);
+ALTER TABLE public.tokens ADD CONSTRAINT tokens_token_key UNIQUE USING INDEX tokens_token_key;
+
+ALTER TABLE public.users DROP CONSTRAINT IF EXISTS users_username_key;
+DROP INDEX CONCURRENTLY IF EXISTS public.users_username_key;
+CREATE UNIQUE INDEX CONCURRENTLY users_username_key ON public.users USING btree (username);
+ALTER TABLE public.users ADD CONSTRAINT users_username_key UNIQUE USING INDEX users_username_key;
+
+DROP INDEX CONCURRENTLY IF EXISTS public.comments_video_id_idx;
+CREATE INDEX CONCURRENTLY comments_video_id_idx ON public.comments USING btree (video, id);
+
+DROP INDEX CONCURRENTLY IF EXISTS public.videos_public_upload_date_idx;
+CREATE INDEX CONCURRENTLY videos_public_upload_date_idx ON public.videos USING btree (upload_date DESC, id DESC) WHERE (private = false);
+
+DROP INDEX CONCURRENTLY IF EXISTS public.videos_owner_upload_date_idx;
+CREATE INDEX CONCURRENTLY videos_owner_upload_date_idx ON public.videos USING btree (owner, upload_date DESC, id DESC);
@@ -0,0 +1,6 @@
+-- comment counts are kept on the video, so showing the count doesn't count every comment
+ALTER TABLE public.videos ADD COLUMN comment_count integer DEFAULT 0 NOT NULL;
+
+UPDATE public.videos V SET comment_count=C.count
+FROM (SELECT video, count(*) AS count FROM public.comments GROUP BY video) AS C
+WHERE V.id=C.video;
@@ -0,0 +1,13 @@
+-- no transaction
+-- full text and trigram search over video titles. the tsvector is a generated column, so it's kept up to date by
+-- postgres whenever a video is inserted or its title changes. adding it rewrites the videos table once
+CREATE EXTENSION IF NOT EXISTS pg_trgm WITH SCHEMA public;
+
+ALTER TABLE public.videos ADD COLUMN IF NOT EXISTS title_search tsvector
+    GENERATED ALWAYS AS (to_tsvector('simple'::regconfig, title)) STORED;
+
+DROP INDEX CONCURRENTLY IF EXISTS public.videos_title_search_idx;
+CREATE INDEX CONCURRENTLY videos_title_search_idx ON public.videos USING gin (title_search);
+
+DROP INDEX CONCURRENTLY IF EXISTS public.videos_title_trgm_idx;
+CREATE INDEX CONCURRENTLY videos_title_trgm_idx ON public.videos USING gin (title public.gin_trgm_ops);
@@ -0,0 +1,6 @@
+-- folders of deleted videos waiting to be removed by the worker
+CREATE TABLE public.deleted_folders (
+    folder text NOT NULL,
+    deleted_at timestamp without time zone DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    CONSTRAINT deleted_folders_pkey PRIMARY KEY (folder)
+);
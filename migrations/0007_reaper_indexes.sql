@@ -0,0 +1,14 @@
+-- no transaction
+-- indexes for deleting expired refresh tokens and anonymous users without anything they made or watched,
+-- each is dropped first so running this again rebuilds one left invalid by a failed build
+DROP INDEX CONCURRENTLY IF EXISTS public.tokens_expires_idx;
+CREATE INDEX CONCURRENTLY tokens_expires_idx ON public.tokens USING btree (expires);
+
+DROP INDEX CONCURRENTLY IF EXISTS public.tokens_uid_idx;
+CREATE INDEX CONCURRENTLY tokens_uid_idx ON public.tokens USING btree (uid);
+
+DROP INDEX CONCURRENTLY IF EXISTS public.comments_owner_idx;
+CREATE INDEX CONCURRENTLY comments_owner_idx ON public.comments USING btree (owner);
+
+DROP INDEX CONCURRENTLY IF EXISTS public.views_user_id_idx;
+CREATE INDEX CONCURRENTLY views_user_id_idx ON public.views USING btree (user_id);
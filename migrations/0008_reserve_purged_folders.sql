@@ -0,0 +1,5 @@
+-- rows of purged folders are kept, so the id of a deleted video is never given to a new upload
+-- (its files and thumbnails are cached as immutable, a new video under the same url would be served stale)
+ALTER TABLE public.deleted_folders ADD COLUMN purged_at timestamp without time zone;
+
+CREATE INDEX deleted_folders_unpurged_idx ON public.deleted_folders USING btree (deleted_at) WHERE (purged_at IS NULL);
@@ -10,6 +10,9 @@ SET client_min_messages = warning;
 SET row_security = off;
 
 
+CREATE EXTENSION IF NOT EXISTS pg_trgm WITH SCHEMA public;
+
+
 CREATE TYPE public.usertype AS ENUM (
     'anonymous',
     'normal',
@@ -76,7 +79,45 @@ CREATE TABLE public.videos (
     private boolean NOT NULL,
     duration integer NOT NULL,
     title text NOT NULL,
-    upload_date timestamp without time zone DEFAULT CURRENT_TIMESTAMP NOT NULL
+    upload_date timestamp without time zone DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    folder text NOT NULL,
+    content_hash text,
+    comment_count integer DEFAULT 0 NOT NULL,
+    title_search tsvector GENERATED ALWAYS AS (to_tsvector('simple'::regconfig, title)) STORED
+);
+
+
+CREATE TABLE public.video_assets (
+    hash text NOT NULL,
+    folder text NOT NULL,
+    refcount integer DEFAULT 1 NOT NULL
+);
+
+
+CREATE TABLE public.video_metadata (
+    video_id text NOT NULL,
+    width integer NOT NULL,
+    height integer NOT NULL,
+    frame_rate real,
+    duration real NOT NULL,
+    bitrate integer,
+    rotation integer DEFAULT 0 NOT NULL,
+    video_codec text,
+    audio_codec text,
+    streams jsonb NOT NULL
+);
+
+
+CREATE TABLE public.deleted_folders (
+    folder text NOT NULL,
+    deleted_at timestamp without time zone DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    purged_at timestamp without time zone
+);
+
+
+CREATE TABLE public.schema_migrations (
+    version text NOT NULL,
+    applied_at timestamp without time zone DEFAULT CURRENT_TIMESTAMP NOT NULL
 );
 
 
@@ -104,6 +145,56 @@ ALTER TABLE ONLY public.videos
     ADD CONSTRAINT videos_pkey PRIMARY KEY (id);
 
 
+ALTER TABLE ONLY public.schema_migrations
+    ADD CONSTRAINT schema_migrations_pkey PRIMARY KEY (version);
+
+
+ALTER TABLE ONLY public.deleted_folders
+    ADD CONSTRAINT deleted_folders_pkey PRIMARY KEY (folder);
+
+
+ALTER TABLE ONLY public.video_metadata
+    ADD CONSTRAINT video_metadata_pkey PRIMARY KEY (video_id);
+
+
+ALTER TABLE ONLY public.video_assets
+    ADD CONSTRAINT video_assets_pkey PRIMARY KEY (hash);
+
+
+ALTER TABLE ONLY public.views
+    ADD CONSTRAINT views_video_id_user_id_key UNIQUE (video_id, user_id);
+
+
+ALTER TABLE ONLY public.tokens
+    ADD CONSTRAINT tokens_token_key UNIQUE (token);
+
+
+ALTER TABLE ONLY public.users
+    ADD CONSTRAINT users_username_key UNIQUE (username);
+
+
+CREATE INDEX comments_video_id_idx ON public.comments USING btree (video, id);
+
+
+CREATE INDEX videos_public_upload_date_idx ON public.videos USING btree (upload_date DESC, id DESC) WHERE (private = false);
+
+CREATE INDEX videos_owner_upload_date_idx ON public.videos USING btree (owner, upload_date DESC, id DESC);
+
+CREATE INDEX videos_title_search_idx ON public.videos USING gin (title_search);
+
+CREATE INDEX videos_title_trgm_idx ON public.videos USING gin (title public.gin_trgm_ops);
+
+CREATE INDEX tokens_expires_idx ON public.tokens USING btree (expires);
+
+CREATE INDEX tokens_uid_idx ON public.tokens USING btree (uid);
+
+CREATE INDEX comments_owner_idx ON public.comments USING btree (owner);
+
+CREATE INDEX views_user_id_idx ON public.views USING btree (user_id);
+
+CREATE INDEX deleted_folders_unpurged_idx ON public.deleted_folders USING btree (deleted_at) WHERE (purged_at IS NULL);
+
+
 ALTER TABLE ONLY public.comments
     ADD CONSTRAINT comments_owner_fkey FOREIGN KEY (owner) REFERENCES public.users(uid);
 
@@ -120,9 +211,20 @@ ALTER TABLE ONLY public.videos
     ADD CONSTRAINT videos_owner_fkey FOREIGN KEY (owner) REFERENCES public.users(uid);
 
 
+ALTER TABLE ONLY public.videos
+    ADD CONSTRAINT videos_content_hash_fkey FOREIGN KEY (content_hash) REFERENCES public.video_assets(hash);
+
+
 ALTER TABLE ONLY public.views
     ADD CONSTRAINT views_user_id_fkey FOREIGN KEY (user_id) REFERENCES public.users(uid);
 
 
 ALTER TABLE ONLY public.views
     ADD CONSTRAINT views_video_id_fkey FOREIGN KEY (video_id) REFERENCES public.videos(id);
+
+
+ALTER TABLE ONLY public.video_metadata
+    ADD CONSTRAINT video_metadata_video_id_fkey FOREIGN KEY (video_id) REFERENCES public.videos(id);
+
+
+INSERT INTO public.schema_migrations (version) VALUES ('0001'), ('0002'), ('0003'), ('0004'), ('0005'), ('0006'), ('0007'), ('0008');
@@ -1,36 +1,78 @@
 from __future__ import annotations
 from dataclasses import dataclass
 from typing import Optional
-import bcrypt
-from flask import request
+from flask import request, after_this_request, Response
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
 from secrets import token_urlsafe
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+import hashlib
+import hmac
+import json
 from enum import Enum
 from random_username.generate import generate_username
 from datetime import datetime, timedelta, timezone
 from functools import wraps
-from redis import Redis
-from src.config import IS_DEV, ANONYMOUS_EXPIRY_DAYS, REFRESH_EXPIRY_DAYS
+import threading
+import time
+from flask import current_app
+from redis import Redis, RedisError
+from src.cache import TTLCache
+from src import password_hashing
+from src.config import IS_DEV, ANONYMOUS_EXPIRY_DAYS, REFRESH_EXPIRY_DAYS, SESSION_EXPIRY_HOURS, SESSION_CACHE_SIZE, SESSION_CACHE_TTL, \
+    USER_CACHE_SIZE, USER_CACHE_TTL, SESSION_FORMAT, SESSION_SECRET_KEY
 
 db: SQLAlchemy = None
 
 
-sessions: dict[str, Session] = {}
+SESSION_EXPIRY = int(SESSION_EXPIRY_HOURS * 60 * 60)
+SESSION_KEY = "session:{token}"
 
-user_cache: dict[int, User] = {}
+# sessions are kept in redis, with the ones in use cached in each worker for a short while
+# redis isn't used in dev environment, so there the cache is where sessions are kept, for as long as they're used
+sessions: TTLCache[str, Session] = TTLCache(SESSION_CACHE_SIZE, SESSION_EXPIRY if IS_DEV else SESSION_CACHE_TTL)
+
+# "signed" sessions aren't stored anywhere, the token itself says who the user is and is checked with the signature
+# a user's signed sessions are revoked all at once by incrementing the user's epoch, tokens from an older epoch are refused
+EPOCH_KEY = "session_epoch:{uid}"
+# epochs are cached in each worker for SESSION_CACHE_TTL seconds, like stored sessions are
+# redis isn't used in dev environment, so there epochs are only kept here
+epochs: TTLCache[int, int] = TTLCache(SESSION_CACHE_SIZE, SESSION_EXPIRY if IS_DEV else SESSION_CACHE_TTL)
+
+# anonymous visitors' refresh tokens are signed too, so there's always a key, dev environment makes one up if it isn't set
+SECRET_KEY = (SESSION_SECRET_KEY or (token_urlsafe(32) if IS_DEV else "")).encode()
+if not SECRET_KEY:
+    raise ValueError("SESSION_SECRET_KEY or FLASK_SECRET_KEY is needed to sign sessions and refresh tokens with")
+
+# refresh tokens of anonymous visitors who haven't been saved to the database yet start with this
+PROVISIONAL_PREFIX = "a."
+
+# every change to a user increments the user's generation in redis and publishes "uid:generation" on USER_CHANNEL
+USER_CHANNEL = "usercache_expire"
+GENERATION_KEY = "user_generation:{uid}"
+
+# dictionary from user id to the user and the generation it was loaded at
+user_cache: TTLCache[int, tuple[User, int]] = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+# the newest generation heard of for each user, so a user loaded just before a change can't be cached after it
+latest_generations: TTLCache[int, int] = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+user_cache_lock = threading.Lock()
+user_invalidations = 0
+
+# set while the listener is subscribed, if it isn't, cached users are checked against their generation in redis
+listening = threading.Event()
+listener: Optional[threading.Thread] = None
+listener_lock = threading.Lock()
 
 
 if not IS_DEV:
-    redis = Redis()
-    redis.select(1)
-    usercache_expire = redis.pubsub()
-    usercache_expire.subscribe("usercache_expire")
+    redis = Redis(db=1)
 
 
 @dataclass
 class User:
-    uid: int
+    # None for an anonymous visitor that hasn't been saved to the database yet
+    uid: Optional[int]
     type: UserType
     username: str
 
@@ -61,107 +103,391 @@ class UserType(str, Enum):
 
 
 # decorator to wrap a request function with, makes sure user session is valid and passes user object as first argument
-def requires_auth():
+# anonymous visitors are only saved to the database by functions with persistent set, the others may get a user without uid
+def requires_auth(persistent: bool = False):
     def _requires_auth(f):
         @wraps(f)
         def __requires_auth(*args, **kwargs):
             if "session" not in request.cookies:
                 return "Unauthorized", 401
 
-            session_token = request.cookies.get("session")
-
-            if session_token not in sessions:
-                # if session token isn't cached, try to load session from redis
-                session_from_redis(session_token)
+            session = load_session(request.cookies.get("session"))
 
             # checks the session token for validity
-            if session_token not in sessions:
+            if not session:
                 return "Unauthorized", 401
 
-            user = sessions[session_token].user
+            user = session.user
+            if persistent:
+                user = persist_user(user)
+                if not user:
+                    return "Unauthorized", 401
             # call the function this decorator is on
             return f(user, *args, **kwargs)
         return __requires_auth
     return _requires_auth
 
 
-# loads session data from redis
-def session_from_redis(session_token):
+# finds a session from the cache, or from redis if it isn't cached
+def load_session(session_token: str):
+    # an anonymous visitor's session token is its refresh token, until it's saved to the database
+    if session_token.startswith(PROVISIONAL_PREFIX):
+        return load_provisional_session(session_token)
+    # stored session tokens never have a "." in them, so tokens of either format keep working when SESSION_FORMAT changes
+    if "." in session_token:
+        return load_signed_session(session_token)
+
     if IS_DEV:
-        return  # redis isn't used in dev environment
-    uid = redis.get(session_token)
+        # sessions expire SESSION_EXPIRY after they were last used
+        return sessions.get(session_token, touch=True)
+
+    session = sessions.get(session_token)
+    if session:
+        return session
+
+    # the expiry is pushed back whenever a worker loads the session, so sessions in use don't expire
+    uid = redis.getex(SESSION_KEY.format(token=session_token), ex=SESSION_EXPIRY)
     if not uid:
-        return
+        return None
     user = get_user(int(uid))
     if not user:
-        return
-    sessions[session_token] = Session(user, session_token)
+        return None
+
+    session = Session(user, session_token)
+    sessions.set(session_token, session)
+    return session
 
 
 # returns a user session if provided with the correct refresh token, if no
 def get_session(refresh_token):
     if not refresh_token:
-        user = create_anonymous_user()
-        session = create_session(user)
+        # nothing is saved for a new visitor, so crawlers and bots don't fill the database
+        refresh = create_provisional_refresh(generate_username()[0])
+        session = load_provisional_session(refresh.token)
         # only anonymous sessions return refresh token with get_session
-        session.refresh = login_anonymous(user)
+        session.refresh = refresh
         return session
 
     user = user_from_refresh(refresh_token)
     if type(user) is AuthError:
         return user
+    if user.uid is None:
+        return load_provisional_session(refresh_token)
 
     session = create_session(user)
 
     return session
 
 
+USERNAME_FREE_SQL = "SELECT uid FROM users WHERE username=:username;"
+
+
 # makes sure a username is not being used
 def username_free(username: str):
-    return not db.session.execute(text("SELECT uid FROM users WHERE username=:username;"), { "username": username }).mappings().fetchone()
+    return not db.session.execute(text(USERNAME_FREE_SQL), { "username": username }).mappings().fetchone()
 
 
 # generates a session token for a user
 def create_session(user: User):
+    if SESSION_FORMAT == "signed":
+        return create_signed_session(user)
+    return create_stored_session(user)
+
+
+def create_stored_session(user: User):
     token = token_urlsafe(32)
     session = Session(user, token)
-    sessions[token] = session
+    sessions.set(token, session)
     if not IS_DEV:
-        redis.mset({ token: user.uid })
+        redis.set(SESSION_KEY.format(token=token), user.uid, ex=SESSION_EXPIRY)
     return session
 
 
+# ends a session, other workers may still accept it for up to SESSION_CACHE_TTL seconds
+def revoke_session(user: User, session_token: str):
+    if user.uid is None:
+        # nothing is saved for anonymous visitors that aren't in the database
+        return
+    if "." in session_token:
+        # a single signed session can't be revoked, only all of the user's sessions
+        revoke_user_sessions(user.uid)
+        return
+
+    sessions.pop(session_token)
+    if not IS_DEV:
+        redis.delete(SESSION_KEY.format(token=session_token))
+
+
+# signed session tokens are the base64 of [uid, type, username, expires, epoch] and its signature, separated by "."
+def create_signed_session(user: User):
+    # read from redis instead of the cache, so a session isn't created from an epoch that was already revoked
+    epoch = session_epoch(user.uid, cached=False)
+    payload = encode_base64(json.dumps([user.uid, user.type, user.username, int(time.time()) + SESSION_EXPIRY, epoch],
+                                       separators=(",", ":")).encode())
+    return Session(user, f"{payload}.{sign(payload)}")
+
+
+def load_signed_session(session_token: str):
+    payload, _, signature = session_token.partition(".")
+    if not verify(payload, signature):
+        return None
+    try:
+        uid, user_type, username, expires, epoch = json.loads(decode_base64(payload))
+    except ValueError:
+        return None
+
+    if expires < time.time() or epoch < session_epoch(uid):
+        return None
+    return Session(User(uid, UserType(user_type), username), session_token)
+
+
+def sign(payload: str):
+    return encode_base64(hmac.new(SECRET_KEY, payload.encode(), hashlib.sha256).digest())
+
+
+# anyone could sign with an empty key, so without a key no signed token is accepted, whatever SESSION_FORMAT is
+def verify(payload: str, signature: str):
+    return bool(SECRET_KEY) and hmac.compare_digest(sign(payload), signature)
+
+
+# provisional refresh tokens are PROVISIONAL_PREFIX, the base64 of [username, expires, nonce] and its signature
+# the signature covers the prefix, so a signed session token can't be passed off as one
+def create_provisional_refresh(username: str):
+    expires = int((datetime.now(timezone.utc) + timedelta(days=ANONYMOUS_EXPIRY_DAYS)).timestamp() * 1000)
+    payload = PROVISIONAL_PREFIX + encode_base64(json.dumps([username, expires, token_urlsafe(16)], separators=(",", ":")).encode())
+    return RefreshToken(f"{payload}.{sign(payload)}", expires)
+
+
+# returns the username and expiry (in milliseconds) of a valid provisional refresh token
+def read_provisional_refresh(refresh_token: str) -> Optional[tuple[str, int]]:
+    payload, _, signature = refresh_token.rpartition(".")
+    if not payload.startswith(PROVISIONAL_PREFIX) or not verify(payload, signature):
+        return None
+    try:
+        username, expires, _ = json.loads(decode_base64(payload[len(PROVISIONAL_PREFIX):]))
+    except ValueError:
+        return None
+
+    if expires < time.time() * 1000:
+        return None
+    return username, expires
+
+
+# the user of an anonymous visitor that isn't in the database has no uid
+def load_provisional_session(session_token: str):
+    refresh = read_provisional_refresh(session_token)
+    if not refresh:
+        return None
+    return Session(User(None, UserType.anonymous, refresh[0]), session_token)
+
+
+# saves an anonymous visitor to the database on its first action that needs a uid, returns the saved user
+# the request's session cookie is replaced with a session of the saved user
+def persist_user(user: User):
+    if user.uid is not None:
+        return user
+
+    user = persist_provisional(request.cookies.get("session", ""))
+    if not user:
+        return None
+    session = create_session(user)
+
+    @after_this_request
+    def replace_session(response: Response):
+        set_session_cookie(response, session.session_token)
+        return response
+
+    return user
+
+
+PROVISIONAL_TOKEN_SQL = "SELECT uid FROM tokens WHERE token=:token"
+
+
+# saves the user of a provisional refresh token with the token, so the token keeps working for the saved user
+def persist_provisional(refresh_token: str):
+    refresh = read_provisional_refresh(refresh_token)
+    if not refresh:
+        return None
+    username, expires = refresh
+
+    sql = text("""WITH new_user AS (INSERT INTO users (type, username) VALUES ('anonymous', :username) RETURNING uid)
+               INSERT INTO tokens (uid, token, expires) SELECT uid, :token, :expires FROM new_user RETURNING uid;""")
+    while True:
+        # the visitor's other requests may have saved it already
+        uid = db.session.execute(text(PROVISIONAL_TOKEN_SQL), { "token": refresh_token }).scalar()
+        if uid:
+            return get_user(uid)
+
+        if not username_free(username):
+            # the username was only checked to be free when it's saved
+            username = generate_username()[0]
+            continue
+
+        try:
+            uid = db.session.execute(sql, {
+                "username": username,
+                "token": refresh_token,
+                "expires": datetime.fromtimestamp(expires / 1000, timezone.utc)
+            }).scalar()
+            db.session.commit()
+        except IntegrityError:
+            # saved by another request at the same time, or the username was just taken, both are handled above
+            db.session.rollback()
+            continue
+
+        user = User(uid, UserType.anonymous, username)
+        cache_user(user, 0)
+        return user
+
+
+def set_session_cookie(response: Response, session_token: str):
+    response.set_cookie("session", session_token, secure=not IS_DEV, httponly=True, samesite="Strict")
+
+
+def encode_base64(data: bytes):
+    return urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def decode_base64(data: str):
+    return urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def session_epoch(uid: int, cached: bool = True):
+    epoch = epochs.get(uid) if cached or IS_DEV else None
+    if epoch is not None or IS_DEV:
+        return epoch or 0
+
+    epoch = int(redis.get(EPOCH_KEY.format(uid=uid)) or 0)
+    epochs.set(uid, epoch)
+    return epoch
+
+
+# ends all of a user's signed sessions, other workers may still accept them for up to SESSION_CACHE_TTL seconds
+# the epoch is never expired, if it was the user's revoked sessions would be accepted again
+def revoke_user_sessions(uid: int):
+    if IS_DEV:
+        epochs.set(uid, session_epoch(uid) + 1)
+    else:
+        epochs.set(uid, redis.incr(EPOCH_KEY.format(uid=uid)))
+
+
+GET_USER_SQL = "SELECT type, username FROM users WHERE uid=:uid;"
+
+
 # loads a user from cache or db by user id
 def get_user(uid: int):
     if not IS_DEV:
-        while True:
-            # delete all expired entries from usercache
-            message = usercache_expire.get_message()
-            if not message:
-                break
-            if message["type"] != "message":
-                continue
-            if message["data"] not in user_cache:
-                continue
-            del user_cache[message["data"]]
-
-    if uid in user_cache:
-        return user_cache[uid]
-
-    user_data = db.session.execute(text("SELECT type, username FROM users WHERE uid=:uid;"), { "uid": uid }).mappings().fetchone()
+        start_listener()
+
+    cached = user_cache.get(uid)
+    if cached:
+        user, generation = cached
+        # without the listener changes may have been missed, so the generation is checked from redis instead
+        if IS_DEV or listening.is_set() or generation == user_generation(uid):
+            return user
+
+    # the generation is read before the user, so if the user changes in between, the older generation is cached with it
+    generation = user_generation(uid)
+    user_data = db.session.execute(text(GET_USER_SQL), { "uid": uid }).mappings().fetchone()
     if not user_data:
         return None
 
     user = User(uid, user_data["type"], user_data["username"])
-    user_cache[uid] = user
+    cache_user(user, generation)
     return user
 
 
+def user_generation(uid: int):
+    if IS_DEV:
+        return 0
+    return int(redis.get(GENERATION_KEY.format(uid=uid)) or 0)
+
+
+def cache_user(user: User, generation: int):
+    with user_cache_lock:
+        if (latest_generations.peek(user.uid) or 0) > generation:
+            return
+        user_cache.set(user.uid, (user, generation))
+
+
+# drops a user from this worker's cache if it's older than the generation
+def invalidate_user(uid: int, generation: int):
+    global user_invalidations
+    with user_cache_lock:
+        if (latest_generations.peek(uid) or 0) < generation:
+            latest_generations.set(uid, generation)
+        cached = user_cache.peek(uid)
+        if cached and cached[1] < generation:
+            user_cache.pop(uid)
+            user_invalidations += 1
+
+
+# tells every worker (this one included) that a user has changed
+def publish_user_change(uid: int):
+    if IS_DEV:
+        # there's only one process in dev environment, the cached user was changed in place
+        return
+    generation = redis.incr(GENERATION_KEY.format(uid=uid))
+    redis.publish(USER_CHANNEL, f"{uid}:{generation}")
+
+
+# starts the thread listening for user changes, done on first use so each forked web worker gets its own
+def start_listener():
+    global listener
+    if listener and listener.is_alive():
+        return
+    with listener_lock:
+        if listener and listener.is_alive():
+            return
+        listener = threading.Thread(target=listen_for_changes, args=(current_app._get_current_object(),),
+                                    name="user-cache-listener", daemon=True)
+        listener.start()
+
+
+def listen_for_changes(app):
+    while True:
+        try:
+            pubsub = redis.pubsub()
+            pubsub.subscribe(USER_CHANNEL)
+            for message in pubsub.listen():
+                if message["type"] == "subscribe":
+                    # changes made while this worker wasn't subscribed were missed
+                    user_cache.clear()
+                    listening.set()
+                elif message["type"] == "message":
+                    uid, generation = message["data"].decode().split(":")
+                    invalidate_user(int(uid), int(generation))
+        except RedisError:
+            app.logger.exception("User cache listener lost its connection to redis")
+        finally:
+            listening.clear()
+        time.sleep(1)
+
+
+# removes what's kept in redis about deleted users
+def forget_users(uids: list[int]):
+    for uid in uids:
+        user_cache.pop(uid)
+    if uids and not IS_DEV:
+        redis.delete(*[GENERATION_KEY.format(uid=uid) for uid in uids], *[EPOCH_KEY.format(uid=uid) for uid in uids])
+
+
+def user_cache_stats():
+    return { **user_cache.stats(), "invalidations": user_invalidations, "listening": IS_DEV or listening.is_set() }
+
+
+USER_FROM_REFRESH_SQL = "SELECT uid FROM tokens WHERE token=:token AND expires>now();"
+
+
 # finds a user by refresh token
 def user_from_refresh(refresh_token: str):
 
-    result = db.session.execute(text("SELECT uid FROM tokens WHERE token=:token AND expires>now();"), { "token": refresh_token }).fetchone()
+    result = db.session.execute(text(USER_FROM_REFRESH_SQL), { "token": refresh_token }).fetchone()
     if not result or len(result) < 1:
+        refresh = read_provisional_refresh(refresh_token)
+        if refresh:
+            # an anonymous visitor that hasn't been saved to the database
+            return User(None, UserType.anonymous, refresh[0])
         # if no result was returned from the db, this means the refresh token didn't exist
         return AuthError("Invalid refresh token.")
 
@@ -173,14 +499,6 @@ def user_from_refresh(refresh_token: str):
     return user
 
 
-# generates a refresh token for an anonymous user
-def login_anonymous(user: User):
-    if user.type != UserType.anonymous:
-        raise ValueError("Tried to anonymous login a non-anonymous user.")
-
-    return generate_refresh(user, ANONYMOUS_EXPIRY_DAYS)
-
-
 def login_normal(username: str, password: str):
     sql = text("SELECT uid, password FROM users WHERE username=:username;")
     result = db.session.execute(sql, { "username": username }).fetchone()
@@ -195,7 +513,7 @@ def login_normal(username: str, password: str):
     if user.type == UserType.anonymous:
         return AuthError("Tried to login as an anonymous user")
 
-    if not bcrypt.checkpw(password.encode("utf-8"), pw_hash.encode("utf-8")):
+    if not password_hashing.check_password(password, pw_hash, username):
         return AuthError("Incorrect password", True)
 
     return generate_refresh(user, REFRESH_EXPIRY_DAYS)
@@ -212,20 +530,6 @@ def generate_refresh(user: User, days: float):
     return RefreshToken(refresh_token, int(expires.timestamp() * 1000))
 
 
-def create_anonymous_user():
-    username = ""
-    # generate a random username and check that it's free
-    while not username or not username_free(username):
-        username = generate_username()[0]
-
-    uid = db.session.execute(text("INSERT INTO users (type, username) VALUES ('anonymous', :username) RETURNING uid;"), { "username": username }).fetchone()[0]
-    db.session.commit()
-
-    user = User(uid, UserType.anonymous, username)
-    user_cache[uid] = user
-    return user
-
-
 def create_normal_user(username: str, password: str):
     if len(username) < 3:
         return AuthError("Username too short", True)
@@ -236,14 +540,14 @@ def create_normal_user(username: str, password: str):
     if not username_free(username):
         return AuthError("Username taken", True)
 
-    hash = bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt())
+    hash = password_hashing.hash_password(password, username)
 
     sql = text("INSERT INTO users (type, username, password) VALUES ('normal', :username, :password) RETURNING uid;")
-    uid = db.session.execute(sql, { "username": username, "password": hash.decode("utf-8") }).fetchone()[0]
+    uid = db.session.execute(sql, { "username": username, "password": hash }).fetchone()[0]
     db.session.commit()
 
     user = User(uid, UserType.normal, username)
-    user_cache[uid] = user
+    cache_user(user, 0)
 
     return generate_refresh(user, REFRESH_EXPIRY_DAYS)
 
@@ -263,31 +567,42 @@ def convert_anonymous_user(username: str, password: str, refresh_token: str):
     if user.type != UserType.anonymous:
         return AuthError("Tried to convert a non-anonymous user")
 
+    if user.uid is None:
+        user = persist_provisional(refresh_token)
+
     if user.username != username:
         # make sure the username is free (only when it's not what it originally was)
         if not username_free(username):
             return AuthError("Username taken", True)
 
-    hash = bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt())
+    hash = password_hashing.hash_password(password, username)
 
     # save changes to db
     sql = text("UPDATE users SET type='normal', username=:username, password=:password WHERE uid=:uid;")
-    db.session.execute(sql, { "uid": user.uid, "username": username, "password": hash.decode("utf-8") })
+    db.session.execute(sql, { "uid": user.uid, "username": username, "password": hash })
     db.session.commit()
 
     # save changes to cache
     user.type = UserType.normal
     user.username = username
 
-    if not IS_DEV:
-        # tell all the other workers this users cached data has expired
-        redis.publish("usercache-expire", user.uid)
+    # tell all the other workers this users cached data has expired
+    publish_user_change(user.uid)
+    # signed sessions have the user type and username in them, so the ones made before the change are revoked
+    revoke_user_sessions(user.uid)
 
     return generate_refresh(user, REFRESH_EXPIRY_DAYS)
 
 
-def logout(user: User, refresh_token: str | None):
+LOGOUT_SQL = "DELETE FROM tokens WHERE token=:token AND uid=:uid"
+
+
+def logout(user: User, refresh_token: str | None, session_token: str | None):
     if refresh_token:
-        sql = text("DELETE FROM tokens WHERE token=:token")
-        db.session.execute(sql, { "token": refresh_token })
+        sql = text(LOGOUT_SQL)
+        db.session.execute(sql, { "token": refresh_token, "uid": user.uid })
         db.session.commit()
+    if session_token:
+        revoke_session(user, session_token)
+
+    return "OK"
@@ -0,0 +1,83 @@
+from collections import OrderedDict
+from time import monotonic
+from typing import Generic, Optional, TypeVar
+import threading
+
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+
+# in-process cache holding at most max_size entries, each for at most ttl seconds
+# the least recently used entry is dropped when it's full, so memory use stays bounded however many keys pass through
+class TTLCache(Generic[K, V]):
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        # dictionary from key to (value, time it expires), least recently used first
+        self.entries: OrderedDict[K, tuple[V, float]] = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    # touch restarts the entry's ttl, for entries that should live as long as they keep being used
+    def get(self, key: K, touch: bool = False) -> Optional[V]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, expires = entry
+            now = monotonic()
+            if expires < now:
+                del self.entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            if touch:
+                self.entries[key] = (value, now + self.ttl)
+            self.hits += 1
+            return value
+
+    # looks an entry up without counting it as a hit or a use
+    def peek(self, key: K) -> Optional[V]:
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry[0] if entry and entry[1] >= monotonic() else None
+
+    def set(self, key: K, value: V):
+        with self.lock:
+            self.entries[key] = (value, monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key: K) -> Optional[V]:
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            return entry[0] if entry else None
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
@@ -0,0 +1,146 @@
+import os
+from shutil import rmtree
+from time import time
+from flask import current_app
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import text
+from src import file_upload, transcode_queue, auth, thumbnails
+from src.config import VIDEO_FOLDER, THUMBNAIL_CACHE_FOLDER, CLEANUP_BATCH_SIZE, ORPHAN_GRACE_HOURS
+
+db: SQLAlchemy = None
+
+
+# removes the folders of deleted videos, ran periodically by the worker. returns how many bytes were freed
+# folders are only marked for deletion in deleted_folders when a video is deleted, so the request doesn't wait for the files
+# the rows are kept after the folders are removed, so is_id_used never gives a deleted video's id to a new upload
+def purge_deleted_folders():
+    freed = 0
+    while True:
+        # SKIP LOCKED lets workers on several nodes purge at the same time without taking the same folders
+        sql = text("""SELECT folder FROM deleted_folders WHERE purged_at IS NULL ORDER BY deleted_at
+                   LIMIT :limit FOR UPDATE SKIP LOCKED""")
+        folders = db.session.execute(sql, { "limit": CLEANUP_BATCH_SIZE }).scalars().all()
+        if not folders:
+            db.session.commit()
+            return freed
+
+        for folder in folders:
+            freed += remove_folder(os.path.join(VIDEO_FOLDER, folder))
+        freed += thumbnails.remove_derivatives(folders)
+
+        sql = text("UPDATE deleted_folders SET purged_at=now() WHERE folder=ANY(:folders)")
+        db.session.execute(sql, { "folders": folders })
+        db.session.commit()
+        current_app.logger.info(f"Removed {len(folders)} deleted video folders ({freed} bytes so far)")
+
+
+# finds what's left behind by failed or abandoned uploads and transcodes, and removes it unless dry_run is set.
+# a folder in VIDEO_FOLDER is an orphan if no video, shared asset or deletion refers to it, no upload or transcode is
+# in progress for it, and nothing in it has changed in ORPHAN_GRACE_HOURS.
+# transcode progress is stale when it isn't over but its video is neither in the database nor in the transcode queue
+def reconcile(dry_run: bool = False):
+    report = { "orphan_folders": 0, "orphan_bytes": 0, "stale_uploads": 0, "stale_progress": 0 }
+
+    # each step reads its state before the next one, so that anything that moves on in between (a folder getting its
+    # video, a queued transcode finishing) is seen in its new state by the later step
+    folders = [entry.name for entry in os.scandir(VIDEO_FOLDER) if entry.is_dir(follow_symlinks=False)]
+    report["stale_uploads"] = file_upload.remove_stale_uploads(dry_run)
+    unfinished = file_upload.unfinished_transcodes()
+    in_progress = transcode_queue.queued_video_ids()
+
+    sql = text("""SELECT folder FROM videos
+               UNION SELECT id FROM videos
+               UNION SELECT folder FROM video_assets
+               UNION SELECT folder FROM deleted_folders WHERE purged_at IS NULL""")
+    known = set(db.session.execute(sql).scalars().all())
+    db.session.commit()
+
+    for video_id in unfinished:
+        if video_id in in_progress or video_id in known:
+            continue
+        report["stale_progress"] += 1
+        if not dry_run:
+            file_upload.abandon_transcode(video_id)
+
+    cutoff = time() - ORPHAN_GRACE_HOURS * 60 * 60
+    for folder in folders:
+        folder_path = os.path.join(VIDEO_FOLDER, folder)
+        if folder in known or folder in in_progress or file_upload.load_pending_upload(folder):
+            continue
+        if os.path.abspath(folder_path) == os.path.abspath(THUMBNAIL_CACHE_FOLDER):
+            continue
+        if last_modified(folder_path) > cutoff:
+            continue
+
+        report["orphan_folders"] += 1
+        report["orphan_bytes"] += folder_size(folder_path) if dry_run else remove_folder(folder_path)
+
+    if not dry_run:
+        current_app.logger.info(f"Reconciled {VIDEO_FOLDER}: {report}")
+    return report
+
+
+# deletes expired refresh tokens, and then anonymous users left with no token and nothing they made or watched,
+# ran periodically by the worker. returns how many tokens and users were deleted
+def reap_expired():
+    report = { "tokens": 0, "users": 0 }
+
+    sql = text("""DELETE FROM tokens WHERE token IN (
+                   SELECT token FROM tokens WHERE expires < now() LIMIT :limit FOR UPDATE SKIP LOCKED
+               )""")
+    while True:
+        deleted = db.session.execute(sql, { "limit": CLEANUP_BATCH_SIZE }).rowcount
+        db.session.commit()
+        report["tokens"] += deleted
+        if deleted < CLEANUP_BATCH_SIZE:
+            break
+
+    sql = text("""DELETE FROM users WHERE uid IN (
+                   SELECT U.uid FROM users U WHERE U.type='anonymous'
+                   AND NOT EXISTS (SELECT 1 FROM tokens T WHERE T.uid=U.uid)
+                   AND NOT EXISTS (SELECT 1 FROM videos V WHERE V.owner=U.uid)
+                   AND NOT EXISTS (SELECT 1 FROM comments C WHERE C.owner=U.uid)
+                   AND NOT EXISTS (SELECT 1 FROM views W WHERE W.user_id=U.uid)
+                   LIMIT :limit FOR UPDATE SKIP LOCKED
+               ) RETURNING uid""")
+    while True:
+        uids = db.session.execute(sql, { "limit": CLEANUP_BATCH_SIZE }).scalars().all()
+        db.session.commit()
+        auth.forget_users(uids)
+        report["users"] += len(uids)
+        if len(uids) < CLEANUP_BATCH_SIZE:
+            break
+
+    if report["tokens"] or report["users"]:
+        current_app.logger.info(f"Deleted {report['tokens']} expired tokens and {report['users']} anonymous users")
+    return report
+
+
+# removes a folder, returns how many bytes it had
+def remove_folder(folder_path: str):
+    size = folder_size(folder_path)
+    rmtree(folder_path, ignore_errors=True)
+    return size
+
+
+def folder_size(folder_path: str):
+    size = 0
+    for root, _, files in os.walk(folder_path):
+        for file in files:
+            try:
+                size += os.lstat(os.path.join(root, file)).st_size
+            except FileNotFoundError:
+                pass
+    return size
+
+
+# newest modification time of the folder or anything in it
+def last_modified(folder_path: str):
+    newest = os.lstat(folder_path).st_mtime
+    for root, dirs, files in os.walk(folder_path):
+        for name in dirs + files:
+            try:
+                newest = max(newest, os.lstat(os.path.join(root, name)).st_mtime)
+            except FileNotFoundError:
+                pass
+    return newest
@@ -0,0 +1,125 @@
+import json
+import threading
+from flask import Response, request
+from flask_sqlalchemy import SQLAlchemy
+from redis import Redis
+from sqlalchemy import text
+from .config import IS_DEV, COMMENTS_PAGE_SIZE, COMMENTS_CACHE_EXPIRY, MAX_PAGE_SIZE
+
+db: SQLAlchemy = None
+
+
+# the first page of a video's comments is cached under the video's comment generation, which posting a comment increments,
+# so a page read from the database just before a comment was posted is cached under a generation nobody reads anymore
+PAGE_KEY = "comments:{video_id}:{generation}"
+GENERATION_KEY = "comments_generation:{video_id}"
+
+
+if not IS_DEV:
+    redis = Redis(db=4)
+
+
+# redis isn't used in dev environment, so there the first pages are cached in the web server process
+first_pages: dict[str, tuple[str, str]] = {}
+first_pages_lock = threading.Lock()
+
+
+# a page of comments, newest first. with "cursor" the page continues after the last comment of the previous page,
+# with "since" it only has comments newer than the one with that id, for refreshing without loading everything again
+def get_comments(video_id: str):
+    try:
+        limit = max(1, min(int(request.args.get("limit") or COMMENTS_PAGE_SIZE), MAX_PAGE_SIZE))
+        cursor = int(request.args["cursor"]) if "cursor" in request.args else None
+        since = int(request.args["since"]) if "since" in request.args else None
+    except ValueError:
+        return { "error": { "message": "invalid arg limit, cursor or since" } }, 400
+
+    if cursor is None and since is None and limit == COMMENTS_PAGE_SIZE:
+        body, etag = get_first_page(video_id)
+    else:
+        body = json.dumps(load_comments(video_id, limit, cursor, since))
+        etag = None
+
+    response = Response(body, mimetype="application/json")
+    if etag:
+        response.set_etag(etag)
+    else:
+        response.add_etag()
+    # answered with 304 Not Modified if the client already has this page
+    return response.make_conditional(request)
+
+
+COMMENTS_SQL = """SELECT C.id, U.username, C.content FROM comments C
+               JOIN users U on U.uid=C.owner
+               WHERE C.video=:video {after_cursor} {after_since}
+               ORDER BY C.id DESC
+               LIMIT :limit + 1"""
+
+
+def load_comments(video_id: str, limit: int, cursor: int | None = None, since: int | None = None):
+    after_cursor = "AND C.id < :cursor" if cursor is not None else ""
+    after_since = "AND C.id > :since" if since is not None else ""
+    sql = text(COMMENTS_SQL.format(after_cursor=after_cursor, after_since=after_since))
+    comments = db.session.execute(sql, { "video": video_id, "limit": limit, "cursor": cursor, "since": since }).mappings().fetchall()
+    comments = [dict(comment) for comment in comments]
+
+    count = db.session.execute(text("SELECT comment_count FROM videos WHERE id=:id"), { "id": video_id }).scalar()
+
+    # one comment more than the limit is fetched, to know if there's more
+    more = len(comments) > limit
+    comments = comments[:limit]
+    return {
+        "comments": comments,
+        "count": count or 0,
+        "next_cursor": comments[-1]["id"] if more and since is None else None,
+        # there were more new comments than fit on a page, the client should load the first page again instead
+        "truncated": more and since is not None
+    }
+
+
+# the first page with its etag, from the cache when possible
+def get_first_page(video_id: str) -> tuple[str, str]:
+    if IS_DEV:
+        with first_pages_lock:
+            if video_id in first_pages:
+                return first_pages[video_id]
+        page = encode_page(load_comments(video_id, COMMENTS_PAGE_SIZE))
+        with first_pages_lock:
+            first_pages[video_id] = page
+        return page
+
+    generation = int(redis.get(GENERATION_KEY.format(video_id=video_id)) or 0)
+    key = PAGE_KEY.format(video_id=video_id, generation=generation)
+    cached = redis.get(key)
+    if cached:
+        return tuple(json.loads(cached))
+
+    page = encode_page(load_comments(video_id, COMMENTS_PAGE_SIZE))
+    redis.set(key, json.dumps(page), ex=COMMENTS_CACHE_EXPIRY)
+    return page
+
+
+def encode_page(page: dict) -> tuple[str, str]:
+    comments = page["comments"]
+    body = json.dumps(page)
+    # the first page only changes when a comment is posted, which changes the newest id and the count
+    etag = f"{comments[0]['id'] if comments else 0}-{page['count']}"
+    return body, etag
+
+
+def post_comment(owner: int, video_id: str, content: str):
+    sql = text("""WITH comment AS (INSERT INTO comments (owner, video, content) VALUES (:owner, :video, :content) RETURNING video)
+               UPDATE videos SET comment_count=comment_count + 1 FROM comment WHERE videos.id=comment.video""")
+    db.session.execute(sql, { "owner": owner, "video": video_id, "content": content })
+    db.session.commit()
+
+    invalidate_first_page(video_id)
+
+
+def invalidate_first_page(video_id: str):
+    if IS_DEV:
+        with first_pages_lock:
+            first_pages.pop(video_id, None)
+        return
+
+    redis.incr(GENERATION_KEY.format(video_id=video_id))
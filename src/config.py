@@ -9,12 +9,97 @@ load_dotenv()
 SITE_NAME = environ.get("SITE_NAME") or "videosite"
 BASE_URL = environ.get("BASE_URL") or "http://localhost:5000"
 VIDEO_FOLDER = environ.get("VIDEO_FOLDER") or "video_data"
+# how files in VIDEO_FOLDER are sent: "flask" sends them from the web worker (with sendfile when the server supports it),
+# "x-accel" hands them to nginx with X-Accel-Redirect and "x-sendfile" to apache or lighttpd with X-Sendfile
+VIDEO_SERVE_MODE = environ.get("VIDEO_SERVE_MODE") or "flask"
+# internal nginx location VIDEO_FOLDER is served from in "x-accel" mode
+VIDEO_ACCEL_PREFIX = environ.get("VIDEO_ACCEL_PREFIX") or "/protected_video_data/"
+# resized and re-encoded thumbnails are cached here, the least recently used are removed when it's over the size limit
+THUMBNAIL_CACHE_FOLDER = environ.get("THUMBNAIL_CACHE_FOLDER") or "thumbnail_cache"
+THUMBNAIL_CACHE_SIZE_MB = float(environ.get("THUMBNAIL_CACHE_SIZE_MB") or 1024)
 
 ANONYMOUS_EXPIRY_DAYS = float(environ.get("ANONYMOUS_EXPIRY_DAYS") or 30)
 REFRESH_EXPIRY_DAYS = float(environ.get("REFRESH_EXPIRY_DAYS") or 30)
 
+# sessions expire after SESSION_EXPIRY_HOURS without being used
+SESSION_EXPIRY_HOURS = float(environ.get("SESSION_EXPIRY_HOURS") or 24)
+# each web worker keeps up to SESSION_CACHE_SIZE sessions in memory, for SESSION_CACHE_TTL seconds before checking
+# redis again, which is also how long a session revoked by another worker can still be used on this one
+SESSION_CACHE_SIZE = int(environ.get("SESSION_CACHE_SIZE") or 10000)
+SESSION_CACHE_TTL = float(environ.get("SESSION_CACHE_TTL") or 30)
+# "redis" keeps sessions in redis, "signed" puts the user in a session token signed with SESSION_SECRET_KEY,
+# which is checked without asking redis, logging out then ends all of the user's sessions
+SESSION_FORMAT = environ.get("SESSION_FORMAT") or "redis"
+SESSION_SECRET_KEY = environ.get("SESSION_SECRET_KEY") or environ.get("FLASK_SECRET_KEY") or ""
+# each web worker keeps up to USER_CACHE_SIZE users in memory, changes are pushed to the other workers through redis,
+# USER_CACHE_TTL (seconds) only limits how long a user can stay stale if a change is missed anyway
+USER_CACHE_SIZE = int(environ.get("USER_CACHE_SIZE") or 10000)
+USER_CACHE_TTL = float(environ.get("USER_CACHE_TTL") or 300)
+# bcrypt cost factor for new password hashes, each one more doubles the time a hash takes
+BCRYPT_ROUNDS = int(environ.get("BCRYPT_ROUNDS") or 12)
+# at most PASSWORD_HASH_QUEUE_SIZE password hashes run at once per web worker, more than that are answered with 429
+PASSWORD_HASH_QUEUE_SIZE = int(environ.get("PASSWORD_HASH_QUEUE_SIZE") or 8)
+# how many logins and signups an address, and logins to a username, can try in PASSWORD_ATTEMPT_WINDOW seconds
+PASSWORD_ATTEMPTS_PER_IP = int(environ.get("PASSWORD_ATTEMPTS_PER_IP") or 20)
+PASSWORD_ATTEMPTS_PER_USERNAME = int(environ.get("PASSWORD_ATTEMPTS_PER_USERNAME") or 10)
+PASSWORD_ATTEMPT_WINDOW = int(environ.get("PASSWORD_ATTEMPT_WINDOW") or 60)
+
 IS_DEV = environ.get("ENVIRONMENT") == "dev"
 
+# uploads are limited to 500mb
+MAX_UPLOAD_SIZE = 500 * 1024 * 1024
+# how long an unfinished resumable upload can be continued
+UPLOAD_EXPIRY_HOURS = float(environ.get("UPLOAD_EXPIRY_HOURS") or 24)
+
+# how many videos a single worker process transcodes at the same time
+TRANSCODE_CONCURRENCY = int(environ.get("TRANSCODE_CONCURRENCY") or 2)
+# how many times a transcode is attempted before the upload is thrown away
+TRANSCODE_MAX_ATTEMPTS = int(environ.get("TRANSCODE_MAX_ATTEMPTS") or 3)
+# transcode progress is saved at most this often (seconds), ffmpeg reports it twice a second
+TRANSCODE_PROGRESS_INTERVAL = float(environ.get("TRANSCODE_PROGRESS_INTERVAL") or 1)
+# how long transcode progress is kept (seconds), so progress of abandoned uploads doesn't pile up
+TRANSCODE_PROGRESS_EXPIRY = int(environ.get("TRANSCODE_PROGRESS_EXPIRY") or 6 * 60 * 60)
+# how long progress of a finished (or failed) transcode is kept (seconds), long enough for the uploader to see the end
+TRANSCODE_PROGRESS_DONE_EXPIRY = int(environ.get("TRANSCODE_PROGRESS_DONE_EXPIRY") or 5 * 60)
+# most videos returned by /api/videos at once
+MAX_PAGE_SIZE = int(environ.get("MAX_PAGE_SIZE") or 100)
+# how many comments are on a page, and how long the first page of a video's comments is cached (seconds)
+COMMENTS_PAGE_SIZE = int(environ.get("COMMENTS_PAGE_SIZE") or 20)
+COMMENTS_CACHE_EXPIRY = int(environ.get("COMMENTS_CACHE_EXPIRY") or 5 * 60)
+# how long a page of the public feed is cached (seconds)
+FEED_CACHE_EXPIRY = int(environ.get("FEED_CACHE_EXPIRY") or 30)
+# views are buffered and written to the database in batches every VIEW_FLUSH_INTERVAL seconds,
+# VIEW_FLUSH_BATCH_SIZE is the most (video, viewer) pairs written in one statement
+VIEW_FLUSH_INTERVAL = float(environ.get("VIEW_FLUSH_INTERVAL") or 10)
+VIEW_FLUSH_BATCH_SIZE = int(environ.get("VIEW_FLUSH_BATCH_SIZE") or 1000)
+# "exact" counts unique viewers with a row per video and viewer in the views table,
+# "hll" estimates them with redis HyperLogLogs instead (only outside of dev environment, which has no redis)
+VIEW_COUNT_MODE = environ.get("VIEW_COUNT_MODE") or "exact"
+# in "hll" mode also keep writing the views table, to audit the estimates against
+VIEW_COUNT_AUDIT = environ.get("VIEW_COUNT_AUDIT") == "1"
+# how many days daily unique viewer estimates are kept in "hll" mode
+VIEW_DAILY_EXPIRY_DAYS = int(environ.get("VIEW_DAILY_EXPIRY_DAYS") or 90)
+# how long it takes for a viewer to count half as much in the trending feed as a new one
+TRENDING_HALF_LIFE_HOURS = float(environ.get("TRENDING_HALF_LIFE_HOURS") or 24)
+# how many videos are kept in the trending feed
+TRENDING_SIZE = int(environ.get("TRENDING_SIZE") or 10000)
+# folders of deleted videos are removed in the background every DELETE_INTERVAL seconds, CLEANUP_BATCH_SIZE at a time
+DELETE_INTERVAL = float(environ.get("DELETE_INTERVAL") or 30)
+CLEANUP_BATCH_SIZE = int(environ.get("CLEANUP_BATCH_SIZE") or 100)
+# VIDEO_FOLDER is checked for folders left behind by failed uploads and transcodes every RECONCILE_INTERVAL seconds,
+# a folder nothing refers to is only removed once nothing in it has changed in ORPHAN_GRACE_HOURS
+RECONCILE_INTERVAL = float(environ.get("RECONCILE_INTERVAL") or 60 * 60)
+ORPHAN_GRACE_HOURS = float(environ.get("ORPHAN_GRACE_HOURS") or UPLOAD_EXPIRY_HOURS + TRANSCODE_PROGRESS_EXPIRY / 60 / 60)
+# expired refresh tokens, and anonymous users without a token or anything they made, are deleted every REAP_INTERVAL seconds
+REAP_INTERVAL = float(environ.get("REAP_INTERVAL") or 60 * 60)
+# the worker serves its metrics on this port of localhost, 0 turns it off
+WORKER_METRICS_PORT = int(environ.get("WORKER_METRICS_PORT") or 9101)
+# a folder every process writes its metrics to, so a scrape of one web worker sees all of them (prometheus_client reads
+# it from the environment too), it has to be emptied before the web server starts
+PROMETHEUS_MULTIPROC_DIR = environ.get("PROMETHEUS_MULTIPROC_DIR")
+# "mp4" transcodes to a single compressed.mp4, "hls" to a segmented adaptive bitrate ladder with a master playlist
+TRANSCODE_OUTPUT = environ.get("TRANSCODE_OUTPUT") or "mp4"
+
 
 def set_config(app: Flask):
     app.config["SQLALCHEMY_DATABASE_URI"] = environ.get("SQLALCHEMY_DATABASE_URI")
@@ -26,5 +111,8 @@ def set_config(app: Flask):
     # session cookie cannot be named "session", since a cookie with that name is used for other things
     app.config["SESSION_COOKIE_NAME"] = "vvc"
 
+    # let the front proxy send files, flask only sets the X-Sendfile header
+    app.config["USE_X_SENDFILE"] = VIDEO_SERVE_MODE == "x-sendfile"
+
     # max content lenght to limit file uploads to 500mb
-    app.config['MAX_CONTENT_LENGTH'] = 500 * 1024 * 1024
+    app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_SIZE
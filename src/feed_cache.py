@@ -0,0 +1,59 @@
+import json
+from time import sleep, monotonic
+from typing import Callable
+from redis import Redis
+from .config import IS_DEV, FEED_CACHE_EXPIRY
+
+
+# public feed pages are cached under the feed version, which changes whenever a video is added, removed or changes
+# privacy, so every cached page becomes unreachable at once and the rest simply expire
+VERSION_KEY = "feed_version"
+PAGE_KEY = "feed:{version}:{page}"
+# only the holder of a page's lock rebuilds it, everyone else waits for the page to appear
+LOCK_KEY = "feed_lock:{version}:{page}"
+# how long a rebuild can take before the lock is given up on (milliseconds)
+LOCK_EXPIRY = 5000
+WAIT_INTERVAL = 0.05
+
+
+if not IS_DEV:
+    redis = Redis(db=4)
+
+
+# a public feed page from the cache, built with load_page when it isn't cached.
+# the page has to be the same for every user, per user filtering happens after this
+def get_page(page: str, load_page: Callable[[], dict]) -> dict:
+    # redis isn't used in dev environment, so there pages aren't cached
+    if IS_DEV:
+        return load_page()
+
+    version = int(redis.get(VERSION_KEY) or 0)
+    key = PAGE_KEY.format(version=version, page=page)
+    lock_key = LOCK_KEY.format(version=version, page=page)
+
+    deadline = monotonic() + LOCK_EXPIRY / 1000
+    while True:
+        cached = redis.get(key)
+        if cached:
+            return json.loads(cached)
+
+        if redis.set(lock_key, 1, nx=True, px=LOCK_EXPIRY):
+            try:
+                result = load_page()
+                redis.set(key, json.dumps(result), ex=FEED_CACHE_EXPIRY)
+                return result
+            finally:
+                # if the rebuild outlived the lock, this can release someone else's lock, which only costs an extra rebuild
+                redis.delete(lock_key)
+
+        if monotonic() > deadline:
+            # whoever is rebuilding the page is taking too long, don't keep the request waiting for them
+            return load_page()
+        sleep(WAIT_INTERVAL)
+
+
+# called after a video is inserted, deleted or made private or public
+def invalidate():
+    if IS_DEV:
+        return
+    redis.incr(VERSION_KEY)
@@ -1,27 +1,46 @@
 from dataclasses import dataclass
+from typing import Optional
 import dataclasses
+import fcntl
+import hashlib
 import json
-from time import sleep
+from time import sleep, monotonic, time
 import ffmpeg
-from flask import request
+from flask import request, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import text
-import subprocess
 import random
 import os
+import subprocess
+import tempfile
 from shutil import rmtree
 from redis import Redis
-from src.config import IS_DEV, VIDEO_FOLDER
+from src import transcode_queue, video_metadata, feed_cache, metrics
+from src.config import IS_DEV, VIDEO_FOLDER, MAX_UPLOAD_SIZE, UPLOAD_EXPIRY_HOURS, TRANSCODE_OUTPUT, TRANSCODE_PROGRESS_INTERVAL, TRANSCODE_PROGRESS_EXPIRY, TRANSCODE_PROGRESS_DONE_EXPIRY
 
 ID_CHARACTERS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz-_'
 
+# how often (seconds) a comment line is sent on progress event streams, so proxies don't close idle connections
+PROGRESS_KEEPALIVE_INTERVAL = 15
+
+# how much of a resumable upload chunk is read from the request at a time
+CHUNK_READ_SIZE = 1024 * 1024
+# how many bytes from the start of a file are needed to recognize the container format
+SNIFF_SIZE = 512
+# most resumable uploads hashed at the same time in one process, the oldest are dropped and hashed again at finalize
+MAX_UPLOAD_HASHERS = 1000
+
+# (height, video bitrate, audio bitrate) of each rendition in the hls output, renditions taller than the source are left out
+HLS_LADDER = [(240, "400k", "64k"), (480, "1000k", "96k"), (720, "2500k", "128k"), (1080, "5000k", "128k")]
+# length of each hls segment in seconds
+HLS_SEGMENT_TIME = 4
+
 
 if not os.path.exists(VIDEO_FOLDER):
     os.mkdir(VIDEO_FOLDER)
 
 if not IS_DEV:
-    redis = Redis()
-    redis.select(2)
+    redis = Redis(db=2)
 
 db: SQLAlchemy = None
 
@@ -32,10 +51,27 @@ class TranscodeProgress:
     title: str
     duration: float
     progress: float
+    failed: bool = False
+
+
+@dataclass
+class PendingUpload:
+    owner: int
+    filename: str
+    size: int
 
 
 # dictionary from video id to transcode progress
 transcode_progresses: dict[str, TranscodeProgress] = {}
+# dictionary from video id to the time its transcode progress expires
+transcode_progress_expiry: dict[str, float] = {}
+
+# dictionary from video id to resumable uploads that haven't been finalized yet
+pending_uploads: dict[str, PendingUpload] = {}
+
+# dictionary from video id to the sha256 of a resumable upload so far, and how many bytes it has hashed
+# chunks are hashed as they come in, when they come to this process in order
+upload_hashers: dict[str, tuple["hashlib._Hash", int]] = {}
 
 
 def handle_upload(owner: int):
@@ -45,29 +81,274 @@ def handle_upload(owner: int):
     if not file.filename:
         return create_error("Cannot accept unnamed file"), 400
 
-    file_extension = file.filename.rsplit('.', 1)[1]
-
     video_id = generate_id()
 
     os.mkdir(os.path.join(VIDEO_FOLDER, video_id))
 
-    # file names only include extensions in dev env
-    file_name = f"original.{file_extension}" if IS_DEV else "original"
+    file_name = original_file_name(file.filename)
+
+    file_path = os.path.join(VIDEO_FOLDER, video_id, file_name)
+
+    # hash the file while saving it
+    hasher = hashlib.sha256()
+    with open(file_path, "wb") as output:
+        while chunk := file.stream.read(CHUNK_READ_SIZE):
+            hasher.update(chunk)
+            output.write(chunk)
+
+    metadata = video_metadata.probe(file_path)
+    if not metadata:
+        cleanup_failed(video_id)
+        return create_error("File is not a valid video")
+
+    return start_transcode(owner, video_id, file_name, file.filename, metadata, hasher.hexdigest())
+
+
+# starts a resumable upload, the file is then sent in chunks with write_chunk and finished with finalize_upload
+def init_upload(owner: int):
+    filename = request.form["filename"]
+    size = int(request.form["size"])
+    if "." not in filename:
+        return create_error("Cannot accept unnamed file"), 400
+    if size <= 0 or size > MAX_UPLOAD_SIZE:
+        return create_error("File is too big"), 413
+
+    video_id = generate_id()
+    os.mkdir(os.path.join(VIDEO_FOLDER, video_id))
+
+    upload = PendingUpload(owner, filename, size)
+    # create the empty file here, so the size of the file on disk can always be used as the upload offset
+    open(os.path.join(VIDEO_FOLDER, video_id, original_file_name(filename)), "wb").close()
+    save_pending_upload(video_id, upload)
+
+    return { "upload_id": video_id, "offset": 0 }
+
+
+# tells the client how much of the upload the server has, so it can continue after a dropped connection
+def upload_status(owner: int, video_id: str):
+    upload = load_pending_upload(video_id)
+    if not upload or upload.owner != owner:
+        return create_error(f"No upload with id \"{video_id}\""), 404
+
+    return { "offset": os.path.getsize(pending_upload_path(video_id, upload)), "size": upload.size }
 
+
+# appends one chunk to a resumable upload, the chunk is streamed to disk as it comes in
+def write_chunk(owner: int, video_id: str):
+    upload = load_pending_upload(video_id)
+    if not upload or upload.owner != owner:
+        return create_error(f"No upload with id \"{video_id}\""), 404
+
+    try:
+        offset = int(request.args["offset"])
+    except (KeyError, ValueError):
+        return create_error("Missing or invalid offset"), 400
+
+    file_path = pending_upload_path(video_id, upload)
+    with open(file_path, "ab", buffering=0) as file:
+        try:
+            # only one request at a time writes to an upload, a client retrying while the first request is still
+            # sending would otherwise append the same bytes twice
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return { "error": "Another chunk of the upload is being written", "offset": os.path.getsize(file_path) }, 409
+
+        # checked while holding the lock, so the size can't change between the check and the write
+        current_offset = file.seek(0, os.SEEK_END)
+        if offset != current_offset:
+            # the client is out of sync (for example after a dropped connection), tell it where to continue from
+            return { "error": "Offset does not match the upload", "offset": current_offset }, 409
+
+        return append_chunk(video_id, upload, file, offset)
+
+
+def append_chunk(video_id: str, upload: PendingUpload, file, offset: int):
+    if offset == 0:
+        # a retried first chunk starts the hash over, the oldest upload is dropped to make room only for a new one
+        upload_hashers.pop(video_id, None)
+        if len(upload_hashers) >= MAX_UPLOAD_HASHERS:
+            upload_hashers.pop(next(iter(upload_hashers)))
+        upload_hashers[video_id] = (hashlib.sha256(), 0)
+    hasher, hashed = upload_hashers.pop(video_id, (None, 0))
+    if hashed != offset:
+        # an earlier chunk went to another process, so this upload is hashed at finalize instead
+        hasher = None
+
+    # the hash as it was before this chunk, for when the chunk is refused after some of it was hashed
+    chunk_start_hasher = hasher.copy() if hasher else None
+    try:
+        if offset == 0:
+            # check the container format from the first bytes, so other files are rejected before the rest is sent
+            chunk = read_stream(SNIFF_SIZE)
+            if not is_video_container(chunk):
+                hasher = None
+                delete_pending_upload(video_id)
+                cleanup_failed(video_id)
+                return create_error("File is not a valid video"), 415
+        else:
+            chunk = request.stream.read(CHUNK_READ_SIZE)
+
+        while chunk:
+            # checked before every write, so nothing past the size the upload was started with reaches the disk
+            if file.tell() + len(chunk) > upload.size:
+                # what was written of this chunk is dropped, so the client can send it again from the same offset
+                file.truncate(offset)
+                file.seek(offset)
+                hasher = chunk_start_hasher
+                return { "error": "Upload is bigger than the size it was started with", "offset": offset }, 413
+            if hasher:
+                hasher.update(chunk)
+            file.write(chunk)
+            chunk = request.stream.read(CHUNK_READ_SIZE)
+    finally:
+        # everything written so far is hashed, also when the connection drops in the middle of the chunk
+        if hasher:
+            upload_hashers[video_id] = (hasher, file.tell())
+
+    return { "offset": file.tell() }
+
+
+def finalize_upload(owner: int, video_id: str):
+    upload = load_pending_upload(video_id)
+    if not upload or upload.owner != owner:
+        return create_error(f"No upload with id \"{video_id}\""), 404
+
+    file_name = original_file_name(upload.filename)
     file_path = os.path.join(VIDEO_FOLDER, video_id, file_name)
+    if os.path.getsize(file_path) != upload.size:
+        return create_error("Upload is not complete"), 409
 
-    file.save(file_path)
+    delete_pending_upload(video_id)
+    hasher, hashed = upload_hashers.pop(video_id, (None, 0))
 
-    if not is_valid_video(file_path):
+    metadata = video_metadata.probe(file_path)
+    if not metadata:
         cleanup_failed(video_id)
         return create_error("File is not a valid video")
 
-    # transcode the video
+    if not hasher or hashed != upload.size:
+        hasher = hash_file(file_path)
+
+    return start_transcode(owner, video_id, file_name, upload.filename, metadata, hasher.hexdigest())
+
+
+def hash_file(file_path: str):
+    hasher = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        while chunk := file.read(CHUNK_READ_SIZE):
+            hasher.update(chunk)
+    return hasher
+
+
+# reads up to size bytes from the request, the stream can return less than asked for at a time
+def read_stream(size: int):
+    data = b""
+    while len(data) < size:
+        chunk = request.stream.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+# checks the magic bytes at the start of a file against known video container formats
+def is_video_container(header: bytes):
+    return (
+        header[4:8] in (b"ftyp", b"moov", b"mdat", b"wide", b"free", b"skip")  # mp4, mov, 3gp
+        or header[:4] == b"\x1a\x45\xdf\xa3"  # matroska, webm
+        or (header[:4] == b"RIFF" and header[8:12] == b"AVI ")
+        or header[:3] == b"FLV"
+        or header[:4] == b"OggS"
+        or header[:4] == b"\x00\x00\x01\xba"  # mpeg program stream
+        or header[:16] == b"\x30\x26\xb2\x75\x8e\x66\xcf\x11\xa6\xd9\x00\xaa\x00\x62\xce\x6c"  # asf, wmv
+        or (len(header) > 188 and header[0] == 0x47 and header[188] == 0x47)  # mpeg transport stream
+    )
+
+
+def original_file_name(filename: str):
+    # file names only include extensions in dev env
+    return f"original.{filename.rsplit('.', 1)[1]}" if IS_DEV else "original"
+
+
+def pending_upload_path(video_id: str, upload: PendingUpload):
+    return os.path.join(VIDEO_FOLDER, video_id, original_file_name(upload.filename))
+
+
+def load_pending_upload(video_id: str):
+    if IS_DEV:
+        return pending_uploads.get(video_id)
+    result = redis.get(f"upload:{video_id}")
+    if not result:
+        return None
+    return PendingUpload(**json.loads(result))
+
+
+def save_pending_upload(video_id: str, upload: PendingUpload):
+    if IS_DEV:
+        pending_uploads[video_id] = upload
+    else:
+        redis.set(f"upload:{video_id}", json.dumps(upload, cls=DataclassEncoder), ex=int(UPLOAD_EXPIRY_HOURS * 60 * 60))
+
+
+def delete_pending_upload(video_id: str):
+    if IS_DEV:
+        pending_uploads.pop(video_id, None)
+    else:
+        redis.delete(f"upload:{video_id}")
+
+
+def start_transcode(owner: int, video_id: str, file_name: str, title: str, metadata: video_metadata.VideoMetadata, content_hash: str):
+    # if the same file has been uploaded and transcoded before, the new video uses the same transcoded files
+    folder = use_shared_asset(content_hash)
+    if folder:
+        # the reference is committed together with the video, so it can't be left behind by an insert that fails
+        try:
+            insert_video(video_id, owner, title, metadata, folder, content_hash)
+        except Exception:
+            db.session.rollback()
+            raise
+        cleanup_failed(video_id)
+        save_transcode_progress(video_id, TranscodeProgress(owner, title, metadata.duration, metadata.duration))
+        return { "video_id": video_id, "folder": folder, "duration": metadata.duration }
+
+    # queue the video for transcoding, the upload request returns right away and a worker picks the job up
     # transcoding is important, as it saves space on the server by compressing files,
     # and since the transcoded video is generated on the server, it should get rid of any trickery with the video metadata
-    video_duration = transcode(owner, video_id, file_name, file.filename)
+    # the metadata travels with the job, so the file doesn't need to be probed again
+    job = transcode_queue.TranscodeJob(video_id, owner, title, file_name, metadata, content_hash=content_hash)
+
+    # initialize a TranscodeProgress object for this transcode, so progress can be asked for while the job is queued
+    # it's saved after the job is queued, so reconcile never finds progress of a job that isn't in the queue yet, and
+    # only if a worker hasn't already picked the job up and saved progress of its own
+    transcode_queue.enqueue(job)
+    save_transcode_progress(video_id, TranscodeProgress(owner, job.title, metadata.duration, 0), only_new=True)
+
+    return { "video_id": video_id, "folder": video_id, "duration": metadata.duration }
+
+
+# takes a reference to the transcoded files of an earlier upload of the same file, returns their folder if there are any
+# the reference isn't committed here, it's committed with the video that uses it by insert_video
+def use_shared_asset(content_hash: str):
+    # refcount is never 0 for an existing row, unless the last video using it is being deleted at the same time
+    sql = text("UPDATE video_assets SET refcount=refcount+1 WHERE hash=:hash AND refcount>0 RETURNING folder")
+    result = db.session.execute(sql, { "hash": content_hash }).fetchone()
+    if not result:
+        db.session.commit()
+        return None
+    return result[0]
 
-    return { "video_id": video_id, "duration": video_duration }
+
+# does nothing if the video is already there, so a transcode job retried after its video was saved doesn't fail on it
+def insert_video(video_id: str, owner: int, title: str, metadata: video_metadata.VideoMetadata, folder: str, content_hash: Optional[str]):
+    sql = text("""INSERT INTO videos (id, owner, title, duration, private, folder, content_hash)
+               VALUES (:id, :owner, :title, :duration, :private, :folder, :content_hash)
+               ON CONFLICT (id) DO NOTHING RETURNING id""")
+    inserted = db.session.execute(sql, { "id": video_id, "owner": owner, "title": title, "duration": metadata.duration,
+                                         "private": False, "folder": folder, "content_hash": content_hash }).fetchone()
+    if inserted:
+        video_metadata.save(video_id, metadata)
+    db.session.commit()
+    feed_cache.invalidate()
 
 
 def cleanup_failed(video_id: str):
@@ -77,132 +358,318 @@ def cleanup_failed(video_id: str):
         rmtree(os.path.join(VIDEO_FOLDER, video_id))
 
 
-def is_valid_video(file_path: str):
-    try:
-        # get all stream codec types in the file
-        codec_types = subprocess.check_output(["ffprobe", "-show_entries", "stream=codec_type", "-of", "csv=p=0", "-v", "error", file_path], stderr=subprocess.PIPE)
-        # check if there is a video stream in the file
-        return b"video" in codec_types.splitlines()
-    except subprocess.CalledProcessError:
-        # subprocess.check_output will throw a CalledProcessError if ffprobe returns non-zero.
-        # Happens if ffprobe can't process the file at all (in which case it's rejected as not a valid video)
-        return False
-
-
-def transcode(owner: int, video_id: str, file_name: str, title: str):
-    input_video = os.path.join(VIDEO_FOLDER, video_id, file_name)
-    output_video = os.path.join(VIDEO_FOLDER, video_id, "compressed.mp4")
-    output_thumbnail = os.path.join(VIDEO_FOLDER, video_id, "thumbnail.png")
-    output_thumbnail_lowres = os.path.join(VIDEO_FOLDER, video_id, "thumbnail-lowres.png")
-
-    # initialize a TranscodeProgress object for this transcode
-    video_duration = get_video_duration(input_video)
-    transcode_progress = TranscodeProgress(owner, title, video_duration, 0)
-    if IS_DEV:
-        transcode_progresses[video_id] = transcode_progress
+# ran by a worker for each job taken from the transcode queue, blocks until ffmpeg is done
+# everything is made by one ffmpeg process, the source is decoded once and split to the video and the thumbnail
+def transcode(job: transcode_queue.TranscodeJob):
+    input_video = os.path.join(VIDEO_FOLDER, job.video_id, job.file_name)
+    output_video = os.path.join(VIDEO_FOLDER, job.video_id, "compressed.mp4")
+    output_thumbnail = os.path.join(VIDEO_FOLDER, job.video_id, "thumbnail.png")
+
+    video_input = ffmpeg.input(input_video)
+    renditions = hls_renditions(job.metadata) if TRANSCODE_OUTPUT == "hls" else []
+    # one branch for each video output, and the last one for the thumbnail
+    video_outputs = max(len(renditions), 1)
+    split = video_input.video.filter_multi_output("split", video_outputs + 1)
+
+    # smaller sizes are made from this one when they're asked for, by /thumbnail/<folder>?w=
+    # (videos transcoded before that still have a thumbnail-lowres.png, nothing reads it anymore)
+    outputs = [split.stream(video_outputs).filter("thumbnail").output(output_thumbnail, frames=1)]
+
+    if renditions:
+        outputs.append(hls_output(job, video_input, [split.stream(i) for i in range(video_outputs)], renditions))
     else:
-        save_transcode_progress_redis(video_id, transcode_progress)
+        streams = [split.stream(0), video_input["a:0"]] if job.metadata.has_audio else [split.stream(0)]
+        outputs.append(ffmpeg.output(*streams, output_video, maxrate="1500k", movflags="faststart"))
 
-    (  # transcode video, reporting progress to http://localhost:5000/setprogress/{video_id}
-        ffmpeg.input(input_video)
-        .output(output_video, maxrate="1500k", progress=f"http://localhost:5000/api/setprogress/{video_id}", movflags="faststart")
-        .run_async(overwrite_output=True, quiet=True)
-    )
-    (  # generate thumbnail
-        ffmpeg.input(input_video)
-        .output(output_thumbnail, vf="thumbnail", frames=1)
-        .run_async(overwrite_output=True, quiet=True)
+    args = (  # transcode video, ffmpeg writes progress to stdout and only errors to stderr
+        ffmpeg.merge_outputs(*outputs)
+        .global_args("-progress", "pipe:1", "-nostats", "-loglevel", "error")
+        .compile(overwrite_output=True)
     )
-    (  # generate low resolution thumbnail
-        ffmpeg.input(input_video)
-        .output(output_thumbnail_lowres, vf="thumbnail", s="376x222", frames=1)
-        .run(overwrite_output=True, quiet=True)
-    )
-    return video_duration
+    # stderr goes to a file, so a video spamming errors can't fill the pipe and block ffmpeg
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=stderr)
+        follow_progress(job, process)
+        if process.wait() != 0:
+            stderr.seek(0)
+            raise ffmpeg.Error("ffmpeg", None, stderr.read())
+
+
+# reads the progress ffmpeg writes to stdout until it exits, saving it at most every TRANSCODE_PROGRESS_INTERVAL seconds
+def follow_progress(job: transcode_queue.TranscodeJob, process: subprocess.Popen):
+    transcode_progress = TranscodeProgress(job.owner, job.title, job.metadata.duration, 0)
+    started = last_saved = monotonic()
+    # the last speed (as a multiple of realtime) and frames per second ffmpeg reported, both averages over the transcode
+    speed = fps = None
+
+    for line in process.stdout:
+        line = line.decode("utf-8").strip()
+
+        if line.startswith("speed=") or line.startswith("fps="):
+            try:
+                value = float(line.split("=")[1].rstrip("x"))
+            except ValueError:
+                # N/A before the first frame is written
+                continue
+            if line.startswith("speed="):
+                speed = value
+            else:
+                fps = value
+
+        elif line.startswith("out_time_us="):
+            try:
+                microseconds = int(line.split("=")[1])
+            except ValueError:
+                # out_time_us is N/A before the first frame is written
+                continue
+            # progress is kept just under 100% until the worker has saved the video in the database
+            # and it never goes backwards, the last report can be for the thumbnail outputs that stopped early
+            progress = min(microseconds / 1000000, transcode_progress.duration * 0.99)
+            transcode_progress.progress = max(transcode_progress.progress, progress)
+
+        # each progress report ends with a "progress=continue" or "progress=end" line
+        elif line.startswith("progress=") and monotonic() - last_saved >= TRANSCODE_PROGRESS_INTERVAL:
+            save_transcode_progress(job.video_id, transcode_progress)
+            last_saved = monotonic()
+
+    if process.wait() == 0:
+        if speed:
+            metrics.ffmpeg_speed.observe(speed)
+        if fps:
+            metrics.ffmpeg_fps.observe(fps)
+        metrics.transcode_realtime_factor.observe(job.metadata.duration / max(monotonic() - started, 0.001))
+
+
+# picks the renditions of the hls ladder for a video: the rungs below the source height, and a top rendition at the
+# source height itself (up to the tallest rung), so a source between rungs doesn't lose quality to the rung below it.
+# the top rendition gets the bitrates of the rung it's rounded up to
+def hls_renditions(metadata: video_metadata.VideoMetadata):
+    top_height = min(metadata.display_height, HLS_LADDER[-1][0])
+    top_height -= top_height % 2
+    rung_above = next(rendition for rendition in HLS_LADDER if rendition[0] >= top_height)
+    return [rendition for rendition in HLS_LADDER if rendition[0] < top_height] + [(top_height, *rung_above[1:])]
+
+
+# output of the video as an hls ladder, each of the split video streams is scaled to one rendition
+def hls_output(job: transcode_queue.TranscodeJob, video_input, video_streams: list, renditions: list[tuple[int, str, str]]):
+    hls_folder = os.path.join(VIDEO_FOLDER, job.video_id, "hls")
+
+    streams = []
+    stream_map = []
+    options = {}
+    for i, (height, video_bitrate, audio_bitrate) in enumerate(renditions):
+        os.makedirs(os.path.join(hls_folder, f"{height}p"), exist_ok=True)
+        streams.append(video_streams[i].filter("scale", -2, height))
+        options[f"b:v:{i}"] = video_bitrate
+        options[f"maxrate:v:{i}"] = video_bitrate
+        options[f"bufsize:v:{i}"] = video_bitrate
+        if job.metadata.has_audio:
+            streams.append(video_input["a:0"])
+            options[f"b:a:{i}"] = audio_bitrate
+            stream_map.append(f"v:{i},a:{i},name:{height}p")
+        else:
+            stream_map.append(f"v:{i},name:{height}p")
+
+    # ffmpeg writes the master playlist to hls/master.m3u8, next to the rendition folders
+    return ffmpeg.output(*streams, os.path.join(hls_folder, "%v", "index.m3u8"),
+                         f="hls", vcodec="libx264", acodec="aac",
+                         # keyframes at the same times in every rendition, so players can switch between them at any segment
+                         force_key_frames=f"expr:gte(t,n_forced*{HLS_SEGMENT_TIME})",
+                         hls_time=HLS_SEGMENT_TIME, hls_playlist_type="vod",
+                         hls_segment_filename=os.path.join(hls_folder, "%v", "segment%03d.ts"),
+                         master_pl_name="master.m3u8", var_stream_map=" ".join(stream_map), **options)
+
+
+# path of the file the player should load, relative to the video's folder
+def video_source(folder: str):
+    if os.path.exists(os.path.join(VIDEO_FOLDER, folder, "hls", "master.m3u8")):
+        return "hls/master.m3u8"
+    return "compressed.mp4"
 
 
 # ran after transcoding video
-def after_transcode(video_id: str):
-    try:
-        sql = text("INSERT INTO videos (id, owner, title, duration, private) VALUES (:id, :owner, :title, :duration, :private)")
-        if IS_DEV:
-            transcode_progress = transcode_progresses[video_id]
-        else:
-            transcode_progress = load_transcode_progress_redis(video_id)
-        duration = transcode_progress.duration
-        owner = transcode_progress.owner
-        title = transcode_progress.title
-        db.session.execute(sql, { "id": video_id, "owner": owner, "title": title, "duration": duration, "private": False })
-        db.session.commit()
-    except:
-        # sleep for a bit in case ffmpeg still has the file in use
-        sleep(0.5)
-        cleanup_failed(video_id)
+def after_transcode(job: transcode_queue.TranscodeJob):
+    content_hash = None
+    if job.content_hash:
+        # make the transcoded files available to later uploads of the same file
+        # if an identical upload finished transcoding first, this video just keeps its own unshared files
+        sql = text("INSERT INTO video_assets (hash, folder) VALUES (:hash, :folder) ON CONFLICT (hash) DO NOTHING RETURNING hash")
+        content_hash = db.session.execute(sql, { "hash": job.content_hash, "folder": job.video_id }).scalar()
 
+    insert_video(job.video_id, job.owner, job.title, job.metadata, job.video_id, content_hash)
 
-def get_video_duration(file_path: str):
-    try:
-        return float(subprocess.check_output(["ffprobe", "-select_streams", "v:0", "-show_entries", "stream=duration", "-of", "csv=p=0", "-v", "error", file_path], stderr=subprocess.PIPE))
-    except ValueError:
-        # .mkv and some other types don't have stream duration so have to check format duration
-        return float(subprocess.check_output(["ffprobe", "-select_streams", "v:0", "-show_entries", "format=duration", "-of", "csv=p=0", "-v", "error", file_path], stderr=subprocess.PIPE))
+    # the video only shows up as done once it's in the database
+    save_transcode_progress(job.video_id, TranscodeProgress(job.owner, job.title, job.metadata.duration, job.metadata.duration))
+
+
+# ran by the worker before a failed transcode is retried
+def reset_transcode_progress(video_id: str):
+    transcode_progress = load_transcode_progress(video_id)
+    if transcode_progress:
+        transcode_progress.progress = 0
+        save_transcode_progress(video_id, transcode_progress)
+
+
+def video_exists(video_id: str):
+    return db.session.execute(text("SELECT 1 FROM videos WHERE id=:id"), { "id": video_id }).fetchone() is not None
+
+
+# ran by the worker when a video has failed to transcode too many times
+def transcode_failed(video_id: str):
+    # a video that made it to the database is live, whatever failed after that, so its files are never removed
+    if video_exists(video_id):
+        return
+    # sleep for a bit in case ffmpeg still has the file in use
+    sleep(0.5)
+    cleanup_failed(video_id)
+
+    transcode_progress = load_transcode_progress(video_id)
+    if transcode_progress:
+        transcode_progress.failed = True
+        save_transcode_progress(video_id, transcode_progress)
 
 
 def get_transcode_progress(video_id: str):
-    transcode_progress = None
+    return progress_response(video_id, load_transcode_progress(video_id))
+
+
+# pushes transcode progress to the client as server-sent events, until the transcode is done or fails
+def stream_transcode_progress(video_id: str):
     if IS_DEV:
-        transcode_progress = transcode_progresses[video_id]
+        events = progress_events_dev(video_id)
     else:
-        transcode_progress = load_transcode_progress_redis(video_id)
+        events = progress_events(video_id)
+    return Response(stream_with_context(events), mimetype="text/event-stream",
+                    # tell nginx not to buffer the stream, events should reach the client right away
+                    headers={ "Cache-Control": "no-cache", "X-Accel-Buffering": "no" })
+
 
+def progress_events(video_id: str):
+    pubsub = redis.pubsub(ignore_subscribe_messages=True)
+    # subscribe before reading the current progress, so no update can be missed in between
+    pubsub.subscribe(f"progress:{video_id}")
+    try:
+        response = progress_response(video_id, load_transcode_progress(video_id))
+        yield format_event(response)
+        last_event = monotonic()
+        while not is_final(response):
+            message = pubsub.get_message(timeout=PROGRESS_KEEPALIVE_INTERVAL)
+            if message:
+                response = json.loads(message["data"])
+                yield format_event(response)
+                last_event = monotonic()
+            elif monotonic() - last_event >= PROGRESS_KEEPALIVE_INTERVAL:
+                yield ": keepalive\n\n"
+                last_event = monotonic()
+    finally:
+        pubsub.close()
+
+
+# redis isn't used in dev environment, so there the progress is just checked every half a second
+def progress_events_dev(video_id: str):
+    last_response = None
+    while True:
+        response = progress_response(video_id, load_transcode_progress(video_id))
+        if response != last_response:
+            yield format_event(response)
+            last_response = response
+        if is_final(response):
+            break
+        sleep(0.5)
+
+
+def progress_response(video_id: str, transcode_progress: TranscodeProgress):
     if not transcode_progress:
         return create_error(f"No progress for video: \"{video_id}\"")
 
+    if transcode_progress.failed:
+        return create_error(f"Transcoding video \"{video_id}\" failed")
+
     # calculate transcode progress in %
-    progress = transcode_progress.progress / transcode_progress.duration * 100
+    return { "progress": transcode_progress.progress / transcode_progress.duration * 100 }
 
-    # if the progress is 100%, remove it from the transcode_progresses dict, since it's not needed anymore
-    # yes I know doing like this could cause a tiny memory leak if the client never requests the progress
-    if progress == 100:
-        if IS_DEV:
-            transcode_progresses.pop(video_id)
-        else:
-            redis.delete(video_id)
 
-    return { "progress": progress }
+# a transcode is over when it's done or has failed, nothing is sent after that
+def is_final(response: dict):
+    return "error" in response or response["progress"] == 100
 
 
-def set_transcode_progress(video_id: str):
-    # this should never happen, but just in case
-    if not IS_DEV:
-        transcode_progress = load_transcode_progress_redis(video_id)
+def format_event(response: dict):
+    return f"data: {json.dumps(response)}\n\n"
+
+
+def load_transcode_progress(video_id: str):
+    if IS_DEV:
+        return transcode_progresses.get(video_id)
+    return load_transcode_progress_redis(video_id)
+
+
+def save_transcode_progress(video_id: str, transcode_progress: TranscodeProgress, only_new: bool = False):
+    # progress is only kept for a while after the transcode is over, and for a longer while before that
+    # so that progress of uploads nobody asks about anymore doesn't pile up
+    response = progress_response(video_id, transcode_progress)
+    expiry = TRANSCODE_PROGRESS_DONE_EXPIRY if is_final(response) else TRANSCODE_PROGRESS_EXPIRY
+
+    if IS_DEV:
+        if only_new and video_id in transcode_progresses:
+            return
+        transcode_progresses[video_id] = transcode_progress
+        transcode_progress_expiry[video_id] = monotonic() + expiry
+        remove_expired_progress()
     else:
-        if video_id not in transcode_progresses:
-            cleanup_failed(video_id)
-            return "Error", 400
-        transcode_progress = transcode_progresses[video_id]
+        if not save_transcode_progress_redis(video_id, transcode_progress, expiry, only_new):
+            return
+        redis.publish(f"progress:{video_id}", json.dumps(response))
 
-    while True:
-        # read one line at a time from the request stream
-        # this is because ffmpeg reports progress in a single http request using a chunked transfer
-        line = request.stream.readline().decode(request.content_encoding or "utf-8").strip("\n\r ")
-        # if the line is len() == 0 or "progress=end", stop reading
-        if len(line) == 0 or line == "progress=end":
-            break
 
-        if line.startswith("out_time_us="):
-            microseconds = float(line.split("=")[1])
-            transcode_progress.progress = microseconds / 1000000
-            if not IS_DEV:
-                save_transcode_progress_redis(video_id, transcode_progress)
+def remove_expired_progress():
+    now = monotonic()
+    for video_id in [video_id for video_id, expires in transcode_progress_expiry.items() if expires < now]:
+        transcode_progresses.pop(video_id, None)
+        transcode_progress_expiry.pop(video_id, None)
 
-    after_transcode(video_id)
 
-    # make sure the progress ends up at 100 (in case of rounding errors, etc.)
-    transcode_progress.progress = transcode_progress.duration
+# removes resumable uploads nobody has continued in UPLOAD_EXPIRY_HOURS, returns how many there were
+# (in redis they expire by themselves, in dev environment they're kept in this process until removed here)
+def remove_stale_uploads(dry_run: bool = False):
     if not IS_DEV:
-        save_transcode_progress_redis(video_id, transcode_progress)
-    return "OK", 200
+        return 0
+
+    stale = 0
+    cutoff = time() - UPLOAD_EXPIRY_HOURS * 60 * 60
+    for video_id, upload in list(pending_uploads.items()):
+        file_path = pending_upload_path(video_id, upload)
+        if not os.path.exists(file_path) or os.path.getmtime(file_path) < cutoff:
+            stale += 1
+            if not dry_run:
+                delete_pending_upload(video_id)
+                upload_hashers.pop(video_id, None)
+    return stale
+
+
+# ids of videos with transcode progress that isn't done or failed yet
+def unfinished_transcodes():
+    if IS_DEV:
+        remove_expired_progress()
+        video_ids = list(transcode_progresses)
+    else:
+        # progress is saved under the bare video id, everything else in this database has a prefix
+        video_ids = [key.decode() for key in redis.scan_iter() if b":" not in key and key != transcode_queue.QUEUE_KEY.encode()]
+
+    unfinished = []
+    for video_id in video_ids:
+        transcode_progress = load_transcode_progress(video_id)
+        if transcode_progress and not is_final(progress_response(video_id, transcode_progress)):
+            unfinished.append(video_id)
+    return unfinished
+
+
+# ends the progress of a transcode whose job was lost, so its uploader isn't left waiting
+def abandon_transcode(video_id: str):
+    transcode_progress = load_transcode_progress(video_id)
+    if transcode_progress:
+        transcode_progress.failed = True
+        save_transcode_progress(video_id, transcode_progress)
 
 
 def load_transcode_progress_redis(video_id: str):
@@ -212,8 +679,8 @@ def load_transcode_progress_redis(video_id: str):
     return TranscodeProgress(**json.loads(result))
 
 
-def save_transcode_progress_redis(video_id: str, transcode_progress: TranscodeProgress):
-    redis.mset({ video_id: json.dumps(transcode_progress, cls=DataclassEncoder)})
+def save_transcode_progress_redis(video_id: str, transcode_progress: TranscodeProgress, expiry: int, only_new: bool = False):
+    return redis.set(video_id, json.dumps(transcode_progress, cls=DataclassEncoder), ex=expiry, nx=only_new)
 
 
 class DataclassEncoder(json.JSONEncoder):
@@ -229,7 +696,11 @@ def create_error(message: str):
 
 # returns True if video_id is used
 def is_id_used(video_id):
-    sql = text("SELECT 1 FROM videos WHERE id=:id")
+    # videos still waiting in the transcode queue only have a folder, not a row in the database
+    if os.path.exists(os.path.join(VIDEO_FOLDER, video_id)):
+        return True
+    # a deleted video's folder can be gone already while it's still waiting to be marked as removed
+    sql = text("SELECT 1 FROM videos WHERE id=:id UNION ALL SELECT 1 FROM deleted_folders WHERE folder=:id")
     return bool(db.session.execute(sql, { "id": video_id }).fetchone())
 
 
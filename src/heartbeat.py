@@ -0,0 +1,30 @@
+import os
+import socket
+from redis import Redis
+from .config import IS_DEV
+
+
+# every worker process keeps a key alive while it runs, so what it has claimed (transcode jobs it's working on, views
+# it's flushing) can be told apart from what a process that died left behind. several worker processes can run on
+# one node, so a process is named by the node and its pid
+ALIVE_KEY = "worker_alive:{worker}"
+# how often (seconds) the key is refreshed, and how long it lives without being refreshed
+INTERVAL = 10
+EXPIRY = 30
+
+
+if not IS_DEV:
+    redis = Redis(db=2)
+
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def beat():
+    if not IS_DEV:
+        redis.set(ALIVE_KEY.format(worker=worker_id()), 1, ex=EXPIRY)
+
+
+def is_alive(worker: str):
+    return bool(redis.exists(ALIVE_KEY.format(worker=worker)))
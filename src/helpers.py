@@ -1,4 +1,5 @@
 from functools import wraps
+from ipaddress import ip_address
 from flask import request
 
 
@@ -22,5 +23,32 @@ def requires_form_data(values: dict[str, type]):
     return _requires_form_data
 
 
+# decorator for internal endpoints, only answers requests made from the server itself
+# requests passed on by a front proxy come from localhost too, so anything with forwarding headers is refused
+def requires_local():
+    def _requires_local(f):
+        @wraps(f)
+        def __requires_local(*args, **kwargs):
+            forwarded = any(header in request.headers for header in ("X-Forwarded-For", "X-Real-IP", "Forwarded"))
+            if forwarded or not request.remote_addr or not ip_address(request.remote_addr).is_loopback:
+                return "Not Found", 404
+
+            return f(*args, **kwargs)
+        return __requires_local
+    return _requires_local
+
+
+# address of the client, requests passed on by a front proxy on the same server come from localhost,
+# so there the address is taken from the header the proxy sets
+def client_ip():
+    if request.remote_addr and ip_address(request.remote_addr).is_loopback:
+        if "X-Real-IP" in request.headers:
+            return request.headers["X-Real-IP"]
+        if "X-Forwarded-For" in request.headers:
+            # the proxy appends the address it got the request from, anything before it came from the client
+            return request.headers["X-Forwarded-For"].split(",")[-1].strip()
+    return request.remote_addr or ""
+
+
 def create_error(message: str):
     return { "error": { "message": message } }
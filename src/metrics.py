@@ -0,0 +1,168 @@
+from time import perf_counter
+from flask import Flask, Response, g, request
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST, \
+    generate_latest, multiprocess, start_http_server
+from prometheus_client.core import GaugeMetricFamily
+from redis import Redis
+from redis.client import Pipeline
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from src import transcode_queue
+from src.config import PROMETHEUS_MULTIPROC_DIR
+from src.helpers import requires_local
+
+
+# metrics are served in the prometheus text format, from /metrics in the web server and from a port of its own in the
+# worker. with PROMETHEUS_MULTIPROC_DIR set every process writes its metrics there, and a scrape of any of them sees
+# the metrics of all of them, otherwise a process only serves its own
+
+# default prometheus buckets (seconds)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# ffmpeg speed and the realtime factor are multiples of realtime
+SPEED_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32)
+FPS_BUCKETS = (5, 10, 25, 50, 100, 200, 400, 800)
+# queries are labelled by their sql, with whitespace collapsed and cut to this many characters
+QUERY_LABEL_LENGTH = 200
+# redis commands that wait for something to happen (like the worker waiting for transcode jobs), their time says how
+# long nothing happened rather than how slow redis is, so they're left out of redis_command_duration_seconds
+BLOCKING_REDIS_COMMANDS = { "BLPOP", "BRPOP", "BRPOPLPUSH", "BLMOVE", "BLMPOP", "BZPOPMIN", "BZPOPMAX", "BZMPOP", "WAIT" }
+
+
+request_duration = Histogram("http_request_duration_seconds", "Time spent handling requests, by route.",
+                             ("method", "route", "status"), buckets=LATENCY_BUCKETS)
+query_duration = Histogram("db_query_duration_seconds", "Time spent running database statements, by statement.", ("query",),
+                           buckets=LATENCY_BUCKETS)
+redis_duration = Histogram("redis_command_duration_seconds", "Time spent on redis commands and pipelines, by command.",
+                           ("db", "command"), buckets=LATENCY_BUCKETS)
+video_bytes_served = Counter("video_data_bytes_served_total", "Bytes of video files sent from /video_data.", ("mode",))
+transcodes = Counter("transcodes_total", "Finished transcodes, by result.", ("result",))
+# summed over the worker processes that are still running
+transcodes_running = Gauge("transcodes_running", "Transcodes running in the worker.", multiprocess_mode="livesum")
+transcode_realtime_factor = Histogram("transcode_realtime_factor", "Seconds of video transcoded per second.",
+                                      buckets=SPEED_BUCKETS)
+ffmpeg_speed = Histogram("ffmpeg_speed", "Encoding speed ffmpeg reported at the end of a transcode.", buckets=SPEED_BUCKETS)
+ffmpeg_fps = Histogram("ffmpeg_fps", "Frames per second ffmpeg reported at the end of a transcode.", buckets=FPS_BUCKETS)
+task_duration = Histogram("worker_task_duration_seconds", "Time spent running the worker's periodic tasks.", ("task",),
+                          buckets=LATENCY_BUCKETS)
+task_failures = Counter("worker_task_failures_total", "Failed runs of the worker's periodic tasks.", ("task",))
+
+
+# the queue is in redis and the same for every process, so it's read when metrics are served rather than kept
+class QueueDepthCollector:
+    def collect(self):
+        gauge = GaugeMetricFamily("transcode_queue_depth", "Transcode jobs waiting in the queue and being transcoded.",
+                                  labels=("state",))
+        for state, depth in transcode_queue.queue_depth().items():
+            gauge.add_metric((state,), depth)
+        yield gauge
+
+
+queue_depth_collector = QueueDepthCollector()
+
+
+# in multiprocess mode the metrics are read from the files of every process on each scrape
+def scrape_registry():
+    if not PROMETHEUS_MULTIPROC_DIR:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(queue_depth_collector)
+    return registry
+
+
+# sets up the measurements for the web server and adds the /metrics route
+def init_app(app: Flask):
+    instrument_database()
+    instrument_redis()
+
+    if not PROMETHEUS_MULTIPROC_DIR:
+        REGISTRY.register(queue_depth_collector)
+
+    @app.before_request
+    def start_timer():
+        g.request_start = perf_counter()
+
+    @app.after_request
+    def save_status(response: Response):
+        g.response_status = response.status_code
+        return response
+
+    # recorded on teardown, which runs also when the request ended with an exception that after_request never saw
+    @app.teardown_request
+    def record_request(exception: BaseException | None):
+        if "request_start" not in g or getattr(app.view_functions.get(request.endpoint), "streaming", False):
+            return
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        status = 500 if exception else g.get("response_status", 500)
+        request_duration.labels(method=request.method, route=route, status=status).observe(perf_counter() - g.request_start)
+
+    @app.route("/metrics")
+    @requires_local()
+    def serve_metrics():
+        return Response(generate_latest(scrape_registry()), content_type=CONTENT_TYPE_LATEST)
+
+
+# marks a view whose response is a stream (like transcode progress events), those last as long as the client stays
+# connected, so they're left out of the request latency
+def streaming(view):
+    view.streaming = True
+    return view
+
+
+# the start is kept on the statement's execution context, so nothing is left behind when a statement fails
+# (after_cursor_execute is only called for statements that succeed)
+def instrument_database():
+    @event.listens_for(Engine, "before_cursor_execute")
+    def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._query_start = perf_counter()
+
+    @event.listens_for(Engine, "after_cursor_execute")
+    def record_query(conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_query_start", None)
+        if start is not None:
+            query_duration.labels(query=query_label(statement)).observe(perf_counter() - start)
+
+
+def query_label(statement: str):
+    return " ".join(statement.split())[:QUERY_LABEL_LENGTH]
+
+
+# redis has no hooks for this, so the methods sending commands and pipelines are wrapped
+# (pub/sub connections send their commands separately, so waiting for messages isn't counted)
+def instrument_redis():
+    if getattr(Redis.execute_command, "instrumented", False):
+        return
+
+    execute_command = Redis.execute_command
+    execute_pipeline = Pipeline.execute
+
+    def timed_command(self, *args, **options):
+        command = str(args[0]).upper()
+        if command in BLOCKING_REDIS_COMMANDS:
+            return execute_command(self, *args, **options)
+        start = perf_counter()
+        try:
+            return execute_command(self, *args, **options)
+        finally:
+            redis_duration.labels(db=redis_db(self), command=command).observe(perf_counter() - start)
+
+    def timed_pipeline(self, *args, **options):
+        start = perf_counter()
+        try:
+            return execute_pipeline(self, *args, **options)
+        finally:
+            redis_duration.labels(db=redis_db(self), command="PIPELINE").observe(perf_counter() - start)
+
+    timed_command.instrumented = True
+    Redis.execute_command = timed_command
+    Pipeline.execute = timed_pipeline
+
+
+def redis_db(redis: Redis):
+    return redis.connection_pool.connection_kwargs.get("db", 0)
+
+
+# serves the metrics on their own port of localhost, for the worker which has no web server
+def serve(port: int):
+    start_http_server(port, addr="127.0.0.1", registry=scrape_registry())
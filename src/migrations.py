@@ -0,0 +1,121 @@
+from datetime import datetime
+import json
+import os
+import re
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import text
+from src import auth, videos, comments, view_count
+
+db: SQLAlchemy = None
+
+
+MIGRATIONS_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "migrations")
+# migrations starting with this line are ran one statement at a time outside of a transaction,
+# which CREATE INDEX CONCURRENTLY needs
+NO_TRANSACTION = "-- no transaction"
+
+
+# migration files in the order they're applied, the version is the number the file name starts with
+def list_migrations() -> list[tuple[str, str]]:
+    migrations = []
+    for file_name in sorted(os.listdir(MIGRATIONS_FOLDER)):
+        match = re.match(r"(\d+)_.*\.sql$", file_name)
+        if match:
+            migrations.append((match.group(1), os.path.join(MIGRATIONS_FOLDER, file_name)))
+    return migrations
+
+
+def applied_versions() -> set[str]:
+    with db.engine.begin() as connection:
+        connection.execute(text("""CREATE TABLE IF NOT EXISTS public.schema_migrations (
+                               version text PRIMARY KEY,
+                               applied_at timestamp without time zone DEFAULT CURRENT_TIMESTAMP NOT NULL
+                           );"""))
+        return { row[0] for row in connection.execute(text("SELECT version FROM public.schema_migrations;")) }
+
+
+# applies every migration that hasn't been applied yet, returns the versions applied
+def migrate():
+    applied = applied_versions()
+    migrated = []
+    for version, file_path in list_migrations():
+        if version in applied:
+            continue
+
+        with open(file_path) as file:
+            sql = file.read()
+
+        if sql.startswith(NO_TRANSACTION):
+            with db.engine.connect() as connection:
+                connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+                for statement in split_statements(sql):
+                    connection.exec_driver_sql(statement)
+                record_version(connection, version)
+        else:
+            with db.engine.begin() as connection:
+                connection.exec_driver_sql(sql)
+                record_version(connection, version)
+
+        migrated.append(os.path.basename(file_path))
+    return migrated
+
+
+def record_version(connection, version: str):
+    connection.execute(text("INSERT INTO public.schema_migrations (version) VALUES (:version);"), { "version": version })
+
+
+# statements end with a semicolon at the end of a line, comments before a statement are sent along with it
+def split_statements(sql: str) -> list[str]:
+    statements = re.split(r";\s*$", sql, flags=re.MULTILINE)
+    return [statement.strip() for statement in statements if strip_comments(statement).strip()]
+
+
+def strip_comments(sql: str):
+    return re.sub(r"--.*$", "", sql, flags=re.MULTILINE)
+
+
+# queries ran on (nearly) every request, taken from the modules that run them, with example parameters to plan them with
+CURSOR = (datetime(2000, 1, 1), "video")
+PAGE = { "cursor_date": CURSOR[0], "cursor_id": CURSOR[1], "limit": 20, "offset": 0 }
+HOT_QUERIES = {
+    "auth.username_free": (auth.USERNAME_FREE_SQL, { "username": "user" }),
+    "auth.get_user": (auth.GET_USER_SQL, { "uid": 1 }),
+    "auth.user_from_refresh": (auth.USER_FROM_REFRESH_SQL, { "token": "token" }),
+    "auth.persist_provisional": (auth.PROVISIONAL_TOKEN_SQL, { "token": "token" }),
+    "auth.logout": (auth.LOGOUT_SQL, { "token": "token", "uid": 1 }),
+    "videos.video_player": (videos.PLAYER_SQL, { "id": "video" }),
+    "videos.load_public_page": (videos.PUBLIC_PAGE_SQL.format(after_cursor=videos.after_cursor(CURSOR)), PAGE),
+    "videos.list_videos own": (videos.OWN_PAGE_SQL.format(after_cursor=videos.after_cursor(CURSOR)), { **PAGE, "owner": 1 }),
+    "videos.list_videos trending": (videos.TRENDING_PAGE_SQL, { "video_ids": ["a", "b"] }),
+    "videos.search_videos": (videos.SEARCH_SQL, { "tsquery": "cat:*", "q": "cat", "owner": 1, "limit": 20, "offset": 0 }),
+    "videos.is_owner": (videos.IS_OWNER_SQL, { "id": "video", "user_id": 1 }),
+    "comments.load_comments": (comments.COMMENTS_SQL.format(after_cursor="AND C.id < :cursor", after_since=""),
+                               { "video": "video", "cursor": 100, "limit": 20 }),
+    "view_count.write_views": (view_count.WRITE_VIEWS_SQL,
+                               { "video_ids": ["a", "b"], "user_ids": [1, 2], "counts": [1, 1], "use_hll": False }),
+    "view_count.viewer_stats": (view_count.TOTAL_VIEWS_SQL, { "id": "video" }),
+    "view_count.viewer_stats audit": (view_count.AUDIT_VIEWERS_SQL, { "id": "video" }),
+}
+
+
+# plans every hot query with sequential scans discouraged, returns the tables each query still scans sequentially.
+# with seq scans off the planner picks any index that applies, even in a nearly empty database,
+# so a sequential scan left in the plan means the query has no index to use
+def check_indexes() -> dict[str, list[str]]:
+    results = {}
+    # nothing is committed, closing the connection rolls the setting back
+    with db.engine.connect() as connection:
+        connection.execute(text("SET LOCAL enable_seqscan = off;"))
+        for name, (sql, params) in HOT_QUERIES.items():
+            plan = connection.execute(text(f"EXPLAIN (FORMAT JSON) {sql}"), params).scalar()
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            results[name] = sequential_scans(plan[0]["Plan"])
+    return results
+
+
+def sequential_scans(node: dict) -> list[str]:
+    scans = [node["Relation Name"]] if node["Node Type"] == "Seq Scan" else []
+    for child in node.get("Plans", []):
+        scans += sequential_scans(child)
+    return scans
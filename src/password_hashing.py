@@ -0,0 +1,81 @@
+from time import time
+import threading
+import bcrypt
+from redis import Redis
+from src.cache import TTLCache
+from src.helpers import client_ip
+from src.config import IS_DEV, BCRYPT_ROUNDS, PASSWORD_HASH_QUEUE_SIZE, \
+    PASSWORD_ATTEMPTS_PER_IP, PASSWORD_ATTEMPTS_PER_USERNAME, PASSWORD_ATTEMPT_WINDOW
+
+
+# attempts are counted in fixed windows, the key has the number of the window in it so old counts simply expire
+ATTEMPTS_KEY = "password_attempts:{kind}:{value}:{window}"
+
+
+if not IS_DEV:
+    redis = Redis(db=1)
+
+
+# redis isn't used in dev environment, so there attempts are counted in the web server process
+attempts: TTLCache[str, int] = TTLCache(10000, PASSWORD_ATTEMPT_WINDOW)
+attempts_lock = threading.Lock()
+
+# hashes running at once in this web worker, more than this are turned away instead of making every login slower
+slots = threading.BoundedSemaphore(PASSWORD_HASH_QUEUE_SIZE)
+
+
+# raised when a hash can't be computed right now, answered with 429
+class Busy(Exception):
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def hash_password(password: str, username: str) -> str:
+    return run(hashpw, username, password.encode("utf-8"), BCRYPT_ROUNDS).decode("utf-8")
+
+
+def check_password(password: str, pw_hash: str, username: str) -> bool:
+    return run(bcrypt.checkpw, username, password.encode("utf-8"), pw_hash.encode("utf-8"))
+
+
+def hashpw(password: bytes, rounds: int):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+# bcrypt takes ~100ms of cpu per hash (with the default rounds), it releases the GIL while hashing so other requests
+# of the web worker keep running, what has to be limited is how many hashes can run at once and who can ask for them
+def run(function, username: str, *args):
+    admit(client_ip(), username)
+
+    if not slots.acquire(blocking=False):
+        raise Busy("Too many logins at the moment, try again soon", 1)
+    try:
+        return function(*args)
+    finally:
+        slots.release()
+
+
+# limits how many hashes a single address, or attempts on a single username, can ask for in a window
+def admit(ip: str, username: str):
+    window = int(time() // PASSWORD_ATTEMPT_WINDOW)
+    keys = [
+        (ATTEMPTS_KEY.format(kind="ip", value=ip, window=window), PASSWORD_ATTEMPTS_PER_IP),
+        (ATTEMPTS_KEY.format(kind="username", value=username.lower(), window=window), PASSWORD_ATTEMPTS_PER_USERNAME)
+    ]
+
+    if IS_DEV:
+        with attempts_lock:
+            counts = [(attempts.peek(key) or 0) + 1 for key, _ in keys]
+            for (key, _), count in zip(keys, counts):
+                attempts.set(key, count)
+    else:
+        pipeline = redis.pipeline()
+        for key, _ in keys:
+            pipeline.incr(key)
+            pipeline.expire(key, PASSWORD_ATTEMPT_WINDOW)
+        counts = pipeline.execute()[::2]
+
+    if any(count > limit for count, (_, limit) in zip(counts, keys)):
+        raise Busy("Too many attempts, try again later", PASSWORD_ATTEMPT_WINDOW - int(time()) % PASSWORD_ATTEMPT_WINDOW)
+
@@ -0,0 +1,135 @@
+import os
+import threading
+from flask import Blueprint, request, send_file
+from PIL import Image, features
+from werkzeug.security import safe_join
+from src.config import VIDEO_FOLDER, THUMBNAIL_CACHE_FOLDER, THUMBNAIL_CACHE_SIZE_MB
+
+
+blueprint = Blueprint('thumbnails', __name__)
+
+
+# widths thumbnails are resized to, a requested width is rounded up to the next one so the cache stays small
+WIDTH_BUCKETS = [160, 376, 640, 1280]
+
+# (mimetype, file extension, Pillow format, save options) in order of preference, jpeg is the fallback every client accepts
+FORMATS = [
+    ("image/avif", "avif", "AVIF", { "quality": 50 }),
+    ("image/webp", "webp", "WEBP", { "quality": 75 }),
+    ("image/jpeg", "jpg", "JPEG", { "quality": 80, "optimize": True, "progressive": True }),
+]
+# avif support depends on how Pillow was built
+if not features.check("avif"):
+    FORMATS = [format for format in FORMATS if format[0] != "image/avif"]
+
+# thumbnails never change once made, so they can be cached by clients for a year
+MAX_AGE = 365 * 24 * 60 * 60
+
+
+if not os.path.exists(THUMBNAIL_CACHE_FOLDER):
+    os.makedirs(THUMBNAIL_CACHE_FOLDER)
+
+# estimated size of the cache folder, None until the folder has been scanned
+cache_size: int | None = None
+cache_lock = threading.Lock()
+
+
+@blueprint.route("/thumbnail/<folder>")
+def thumbnail(folder: str):
+    source = safe_join(VIDEO_FOLDER, folder, "thumbnail.png")
+    # checked also when the derivative is cached, so thumbnails of deleted videos aren't served
+    if not source or not os.path.exists(source):
+        return "Not Found", 404
+
+    try:
+        width = int(request.args.get("w", WIDTH_BUCKETS[-1]))
+    except ValueError:
+        return "Bad Request", 400
+    width = next((bucket for bucket in WIDTH_BUCKETS if bucket >= width), WIDTH_BUCKETS[-1])
+
+    mimetype, extension, image_format, options = negotiate_format()
+
+    path = os.path.join(THUMBNAIL_CACHE_FOLDER, f"{folder}-{width}.{extension}")
+    try:
+        # the modification time is used as the last use time for evicting the least recently used derivatives
+        os.utime(path)
+    except FileNotFoundError:
+        create_derivative(source, path, width, image_format, options)
+
+    response = send_file(path, mimetype=mimetype, max_age=MAX_AGE)
+    response.cache_control.immutable = True
+    # the same url gives a different format depending on the Accept header
+    response.vary.add("Accept")
+    return response
+
+
+def negotiate_format():
+    # only formats the client lists by name count, "*/*" would match anything
+    accepted = [mimetype for mimetype, quality in request.accept_mimetypes if quality > 0]
+    for format in FORMATS[:-1]:
+        if format[0] in accepted:
+            return format
+    return FORMATS[-1]
+
+
+def create_derivative(source: str, path: str, width: int, image_format: str, options: dict):
+    with Image.open(source) as image:
+        image = image.convert("RGB")
+        if image.width > width:
+            image = image.resize((width, round(image.height * width / image.width)), Image.Resampling.LANCZOS)
+        # written to a temporary file first, so a half written derivative is never served
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        image.save(temporary_path, image_format, **options)
+    os.replace(temporary_path, path)
+    add_to_cache(path)
+
+
+# keeps the cache folder under THUMBNAIL_CACHE_SIZE_MB by removing the least recently used derivatives
+def add_to_cache(new_path: str):
+    global cache_size
+    with cache_lock:
+        if cache_size is not None:
+            cache_size += os.path.getsize(new_path)
+            if cache_size <= THUMBNAIL_CACHE_SIZE_MB * 1024 * 1024:
+                return
+
+        entries = []
+        for entry in os.scandir(THUMBNAIL_CACHE_FOLDER):
+            # the derivative just made is about to be sent, so it's never evicted right away
+            if entry.is_file() and not entry.name.endswith(".tmp") and entry.path != new_path:
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        cache_size = sum(entry[1] for entry in entries) + os.path.getsize(new_path)
+
+        # evict down to 90% of the limit, so this doesn't run again on the very next derivative
+        limit = THUMBNAIL_CACHE_SIZE_MB * 1024 * 1024 * 0.9
+        for _, size, path in sorted(entries):
+            if cache_size <= limit:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # another process removed it already
+                pass
+            cache_size -= size
+
+
+# removes the cached derivatives of purged folders, so they aren't kept around until they're evicted
+# returns how many bytes were freed
+def remove_derivatives(folders: list[str]):
+    global cache_size
+    folders = set(folders)
+    freed = 0
+    for entry in os.scandir(THUMBNAIL_CACHE_FOLDER):
+        # derivatives are named {folder}-{width}.{extension}, and folder ids can have "-" in them
+        if entry.is_file() and entry.name.rsplit("-", 1)[0] in folders:
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            freed += size
+    with cache_lock:
+        if cache_size is not None:
+            cache_size -= freed
+    return freed
@@ -0,0 +1,111 @@
+from dataclasses import dataclass, asdict
+import json
+import queue
+from typing import Optional
+from redis import Redis
+from src import heartbeat
+from src.config import IS_DEV
+from src.video_metadata import VideoMetadata
+
+
+QUEUE_KEY = "transcode_queue"
+# jobs taken by a worker but not finished yet, one list per worker process, so the jobs of a process that died can be
+# put back in the queue without touching the ones other processes are working on
+PROCESSING_KEY = "transcode_processing:{worker}"
+
+
+if not IS_DEV:
+    redis = Redis(db=2)
+
+
+# redis isn't used in dev environment, so there jobs are passed to worker threads running in the web server process
+local_queue: queue.Queue[str] = queue.Queue()
+local_processing: list[str] = []
+
+
+@dataclass
+class TranscodeJob:
+    video_id: str
+    owner: int
+    title: str
+    file_name: str
+    metadata: VideoMetadata
+    attempts: int = 0
+    # sha256 of the uploaded file, the transcoded files are shared with later uploads of the same file
+    content_hash: Optional[str] = None
+
+    def __post_init__(self):
+        # metadata is a plain dict when the job is loaded from json
+        if isinstance(self.metadata, dict):
+            self.metadata = VideoMetadata(**self.metadata)
+
+
+def enqueue(job: TranscodeJob):
+    if IS_DEV:
+        local_queue.put(encode(job))
+    else:
+        redis.lpush(QUEUE_KEY, encode(job))
+
+
+# takes the next job from the queue, waits at most timeout seconds for one to show up
+def dequeue(timeout: int = 5) -> Optional[TranscodeJob]:
+    if IS_DEV:
+        try:
+            data = local_queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        local_processing.append(data)
+    else:
+        # the job is moved to the processing list in the same step, so it isn't lost if the worker dies mid transcode
+        data = redis.blmove(QUEUE_KEY, processing_key(), timeout, "RIGHT", "LEFT")
+        if not data:
+            return None
+    return TranscodeJob(**json.loads(data))
+
+
+# removes a finished (or failed) job from the processing list
+def complete(job: TranscodeJob):
+    if IS_DEV:
+        local_processing.remove(encode(job))
+    else:
+        redis.lrem(processing_key(), 1, encode(job))
+
+
+def processing_key():
+    return PROCESSING_KEY.format(worker=heartbeat.worker_id())
+
+
+# puts jobs left in processing lists by worker processes that died back to the front of the queue, ran when a worker
+# starts and periodically after that. each job is moved on its own, so workers doing this at the same time don't
+# requeue a job twice
+def requeue_unfinished():
+    if IS_DEV:
+        return
+    for key in redis.scan_iter(PROCESSING_KEY.format(worker="*")):
+        if heartbeat.is_alive(key.decode().split(":", 1)[1]):
+            continue
+        while redis.lmove(key, QUEUE_KEY, "LEFT", "RIGHT"):
+            pass
+
+
+def queue_depth():
+    if IS_DEV:
+        return { "queued": local_queue.qsize(), "processing": len(local_processing) }
+
+    processing = sum(redis.llen(key) for key in redis.scan_iter(PROCESSING_KEY.format(worker="*")))
+    return { "queued": redis.llen(QUEUE_KEY), "processing": processing }
+
+
+# ids of videos waiting in the queue or being transcoded on any node
+def queued_video_ids() -> set[str]:
+    if IS_DEV:
+        jobs = list(local_queue.queue) + local_processing
+    else:
+        jobs = redis.lrange(QUEUE_KEY, 0, -1)
+        for key in redis.scan_iter(PROCESSING_KEY.format(worker="*")):
+            jobs += redis.lrange(key, 0, -1)
+    return { json.loads(job)["video_id"] for job in jobs }
+
+
+def encode(job: TranscodeJob):
+    return json.dumps(asdict(job))
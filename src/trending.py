@@ -0,0 +1,91 @@
+from time import time
+import threading
+from redis import Redis
+from .config import IS_DEV, TRENDING_HALF_LIFE_HOURS, TRENDING_SIZE
+
+
+# sorted set of video ids, scored by new viewers weighted by when they came,
+# a viewer's weight doubles every half life, which is the same as older viewers decaying relative to new ones
+TRENDING_KEY = "trending"
+# time the weights are relative to, moved forward (and the scores scaled down) before they get too big for a float
+EPOCH_KEY = "trending_epoch"
+REBASE_AFTER_HALF_LIVES = 64
+
+HALF_LIFE = TRENDING_HALF_LIFE_HOURS * 60 * 60
+
+
+if not IS_DEV:
+    redis = Redis(db=3)
+
+
+# redis isn't used in dev environment, so there scores are kept in the web server process
+scores: dict[str, float] = {}
+scores_epoch = time()
+scores_lock = threading.Lock()
+
+
+def weight(now: float, epoch: float):
+    return 2 ** ((now - epoch) / HALF_LIFE)
+
+
+# adds new viewers to the scores of public videos, called when views are flushed to the database
+def add_viewers(viewers: dict[str, int]):
+    if not viewers:
+        return
+    now = time()
+
+    if IS_DEV:
+        global scores_epoch
+        with scores_lock:
+            if now - scores_epoch > REBASE_AFTER_HALF_LIVES * HALF_LIFE:
+                factor = weight(scores_epoch, now)
+                for video_id in scores:
+                    scores[video_id] *= factor
+                scores_epoch = now
+
+            for video_id, count in viewers.items():
+                scores[video_id] = scores.get(video_id, 0) + count * weight(now, scores_epoch)
+
+            if len(scores) > TRENDING_SIZE:
+                for video_id in sorted(scores, key=scores.get)[:len(scores) - TRENDING_SIZE]:
+                    scores.pop(video_id)
+        return
+
+    def increment(pipeline):
+        epoch = pipeline.get(EPOCH_KEY)
+        epoch = float(epoch) if epoch else None
+        pipeline.multi()
+
+        if epoch is None or now - epoch > REBASE_AFTER_HALF_LIVES * HALF_LIFE:
+            if epoch is not None:
+                pipeline.zunionstore(TRENDING_KEY, { TRENDING_KEY: weight(epoch, now) })
+            epoch = now
+            pipeline.set(EPOCH_KEY, epoch)
+
+        for video_id, count in viewers.items():
+            pipeline.zincrby(TRENDING_KEY, count * weight(now, epoch), video_id)
+        # only the top of the set is ever read, the rest would only grow it
+        pipeline.zremrangebyrank(TRENDING_KEY, 0, -TRENDING_SIZE - 1)
+
+    # retried if another process rebases the scores in between
+    redis.transaction(increment, EPOCH_KEY)
+
+
+# video ids on a page of the trending feed, most trending first
+def get_page(limit: int, offset: int) -> list[str]:
+    start = offset * limit
+    if IS_DEV:
+        with scores_lock:
+            return sorted(scores, key=scores.get, reverse=True)[start:start + limit]
+
+    return [video_id.decode() for video_id in redis.zrevrange(TRENDING_KEY, start, start + limit - 1)]
+
+
+# removes a video from the feed when it's deleted or made private
+def remove(video_id: str):
+    if IS_DEV:
+        with scores_lock:
+            scores.pop(video_id, None)
+        return
+
+    redis.zrem(TRENDING_KEY, video_id)
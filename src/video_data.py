@@ -0,0 +1,50 @@
+import mimetypes
+import os
+from flask import Response, request, send_file
+from werkzeug.security import safe_join
+from src import metrics
+from src.config import VIDEO_FOLDER, VIDEO_SERVE_MODE, VIDEO_ACCEL_PREFIX
+
+
+# files in a video's folder are never changed after they are written, so clients and proxies can cache them for a year
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+# serves a file from VIDEO_FOLDER, the bytes are sent by the front proxy when VIDEO_SERVE_MODE allows it
+def serve(filename: str):
+    path = safe_join(VIDEO_FOLDER, filename)
+    # the original upload is only kept for transcoding, it's never served (it can have metadata the transcode gets rid of)
+    if not path or not os.path.isfile(path) or os.path.basename(path).startswith("original"):
+        return "Not Found", 404
+
+    stat = os.stat(path)
+    # a strong etag is safe, since the same path never gets different contents
+    etag = f"{stat.st_ino:x}-{stat.st_size:x}-{int(stat.st_mtime):x}"
+
+    if VIDEO_SERVE_MODE == "x-accel":
+        return accel_redirect(filename, etag)
+
+    # with USE_X_SENDFILE (set for "x-sendfile" mode) flask only sends the X-Sendfile header,
+    # otherwise the file is sent with the server's wsgi.file_wrapper, which uses sendfile when the server supports it
+    response = send_file(path, etag=etag, conditional=True)
+    response.headers["Cache-Control"] = CACHE_CONTROL
+    # only what's sent from here is counted, in "x-sendfile" and "x-accel" modes the proxy sends the bytes (or a range
+    # of them, or nothing for a 304) and its own logs have them
+    if VIDEO_SERVE_MODE == "flask":
+        metrics.video_bytes_served.labels(mode=VIDEO_SERVE_MODE).inc(response.content_length or 0)
+    return response
+
+
+# hands the transfer to nginx, which serves the file (and range requests from seeking) from an internal location
+def accel_redirect(filename: str, etag: str):
+    response = Response()
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = CACHE_CONTROL
+
+    if request.if_none_match.contains(etag):
+        response.status_code = 304
+        return response
+
+    response.headers["X-Accel-Redirect"] = VIDEO_ACCEL_PREFIX + filename
+    response.content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    return response
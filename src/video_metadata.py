@@ -0,0 +1,116 @@
+from __future__ import annotations
+from dataclasses import dataclass, asdict
+from fractions import Fraction
+from typing import Optional
+import json
+import subprocess
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import text
+
+db: SQLAlchemy = None
+
+
+@dataclass
+class StreamInfo:
+    index: int
+    codec_type: str
+    codec_name: Optional[str]
+
+
+@dataclass
+class VideoMetadata:
+    duration: float
+    width: int
+    height: int
+    frame_rate: Optional[float]
+    bitrate: Optional[int]
+    rotation: int
+    video_codec: Optional[str]
+    audio_codec: Optional[str]
+    streams: list[StreamInfo]
+
+    def __post_init__(self):
+        # streams are plain dicts when loaded from json
+        self.streams = [StreamInfo(**stream) if isinstance(stream, dict) else stream for stream in self.streams]
+
+    @property
+    def has_audio(self):
+        return self.audio_codec is not None
+
+    # height of the video as it's shown, ffmpeg rotates the video when transcoding
+    @property
+    def display_height(self):
+        return self.width if self.rotation % 180 == 90 else self.height
+
+
+# probes a file with a single ffprobe call, returns None if the file isn't a valid video
+def probe(file_path: str):
+    try:
+        output = subprocess.check_output(["ffprobe", "-print_format", "json", "-show_streams", "-show_format", "-v", "error", file_path], stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError:
+        # subprocess.check_output will throw a CalledProcessError if ffprobe returns non-zero.
+        # Happens if ffprobe can't process the file at all (in which case it's rejected as not a valid video)
+        return None
+
+    result = json.loads(output)
+    streams = result.get("streams", [])
+    video = next((stream for stream in streams if stream.get("codec_type") == "video"), None)
+    if not video:
+        return None
+    audio = next((stream for stream in streams if stream.get("codec_type") == "audio"), None)
+    container = result.get("format", {})
+
+    # .mkv and some other types don't have stream duration so have to use format duration
+    duration = video.get("duration") or container.get("duration")
+    if not duration:
+        return None
+
+    return VideoMetadata(
+        duration=float(duration),
+        width=int(video.get("width", 0)),
+        height=int(video.get("height", 0)),
+        frame_rate=parse_frame_rate(video.get("avg_frame_rate")) or parse_frame_rate(video.get("r_frame_rate")),
+        bitrate=int(container["bit_rate"]) if "bit_rate" in container else None,
+        rotation=parse_rotation(video),
+        video_codec=video.get("codec_name"),
+        audio_codec=audio.get("codec_name") if audio else None,
+        streams=[StreamInfo(stream["index"], stream.get("codec_type"), stream.get("codec_name")) for stream in streams]
+    )
+
+
+# frame rates are fractions like "30000/1001", "0/0" when unknown
+def parse_frame_rate(value: Optional[str]):
+    try:
+        frame_rate = Fraction(value)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+    return float(frame_rate) if frame_rate else None
+
+
+# rotation is a tag in older files and display matrix side data in newer ones
+def parse_rotation(stream: dict):
+    rotation = stream.get("tags", {}).get("rotate")
+    for side_data in stream.get("side_data_list", []):
+        if "rotation" in side_data:
+            rotation = side_data["rotation"]
+    try:
+        return int(float(rotation or 0)) % 360
+    except ValueError:
+        return 0
+
+
+def save(video_id: str, metadata: VideoMetadata):
+    sql = text("""INSERT INTO video_metadata (video_id, width, height, frame_rate, duration, bitrate, rotation, video_codec, audio_codec, streams)
+               VALUES (:video_id, :width, :height, :frame_rate, :duration, :bitrate, :rotation, :video_codec, :audio_codec, :streams)""")
+    values = asdict(metadata)
+    values["streams"] = json.dumps(values["streams"])
+    db.session.execute(sql, { "video_id": video_id, **values })
+
+
+def load(video_id: str):
+    sql = text("""SELECT width, height, frame_rate, duration, bitrate, rotation, video_codec, audio_codec, streams
+               FROM video_metadata WHERE video_id=:video_id""")
+    result = db.session.execute(sql, { "video_id": video_id }).mappings().fetchone()
+    if not result:
+        return None
+    return VideoMetadata(**result)
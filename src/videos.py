@@ -2,10 +2,12 @@ from enum import Enum
 from flask_sqlalchemy import SQLAlchemy
 from flask import Blueprint, request
 from sqlalchemy import text
-from src import auth, helpers
-from os import path
-from shutil import rmtree
-from src.config import VIDEO_FOLDER, BASE_URL
+from src import auth, helpers, view_count, trending, comments, feed_cache
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
+import json
+import re
+from src.config import BASE_URL, MAX_PAGE_SIZE
 
 db: SQLAlchemy = None
 
@@ -13,28 +15,92 @@ db: SQLAlchemy = None
 blueprint = Blueprint('videos', __name__)
 
 
+# queries used by the pages and lists of videos, the ones with {after_cursor} are formatted with after_cursor()
+PLAYER_SQL = """SELECT V.id, V.views, V.duration, V.title, V.folder, M.width, M.height, M.rotation FROM videos V
+               LEFT JOIN video_metadata M ON M.video_id=V.id
+               WHERE V.id=:id"""
+TRENDING_PAGE_SQL = """SELECT V.id, V.folder, V.views, V.duration, V.title, U.username AS owner FROM videos V
+                   JOIN users U ON U.uid=V.owner
+                   WHERE V.id=ANY(CAST(:video_ids AS text[])) AND V.private=false
+                   ORDER BY array_position(CAST(:video_ids AS text[]), V.id);"""
+OWN_PAGE_SQL = """SELECT V.id, V.folder, V.views, V.duration, V.title, V.private, V.upload_date
+               FROM videos V WHERE V.owner=:owner {after_cursor}
+               ORDER BY V.upload_date DESC, V.id DESC
+               LIMIT(:limit + 1) OFFSET(:offset*:limit);"""
+PUBLIC_PAGE_SQL = """SELECT V.id, V.folder, V.views, V.duration, V.title, U.username AS owner, V.owner AS owner_uid, V.upload_date
+               FROM videos V
+               JOIN users U ON U.uid=V.owner
+               WHERE V.private=false {after_cursor}
+               ORDER BY V.upload_date DESC, V.id DESC
+               LIMIT(:limit + 1) OFFSET(:offset*:limit);"""
+# matches either every word (as a prefix) from the full text index, or the whole query closely enough from the
+# trigram index to catch typos, ranked by both
+SEARCH_SQL = """SELECT V.id, V.folder, V.views, V.duration, V.title, U.username AS owner, V.private,
+                      ts_rank(V.title_search, Q.query) + word_similarity(:q, V.title) AS rank
+                  FROM videos V
+                  JOIN users U ON U.uid=V.owner
+                  CROSS JOIN to_tsquery('simple', :tsquery) AS Q(query)
+                  WHERE (V.private=false OR V.owner=:owner)
+                  AND (V.title_search @@ Q.query OR :q <% V.title)
+                  ORDER BY rank DESC, V.id
+                  LIMIT(:limit + 1) OFFSET(:offset*:limit);"""
+IS_OWNER_SQL = "SELECT * FROM videos WHERE id=:id AND owner=:user_id"
+
+
 @blueprint.route("/api/video/<id>", methods=["DELETE"])
 @auth.requires_auth()
 def delete_video(user: auth.User, id: str):
     if not is_owner(id, user):
         return helpers.create_error("You don't own this video"), 403
 
-    sql = text("DELETE FROM videos WHERE id=:id")
+    sql = text("DELETE FROM views WHERE video_id=:id")
     db.session.execute(sql, { "id": id })
 
-    sql = text("DELETE FROM views WHERE video_id=:id")
+    sql = text("DELETE FROM comments WHERE video=:id")
+    db.session.execute(sql, { "id": id })
+
+    sql = text("DELETE FROM video_metadata WHERE video_id=:id")
     db.session.execute(sql, { "id": id })
 
-    # remove the entire folder created for the video
-    video_data_path = path.join(VIDEO_FOLDER, id)
-    if path.exists(video_data_path):
-        rmtree(video_data_path)
+    sql = text("DELETE FROM videos WHERE id=:id RETURNING folder, content_hash")
+    folder, content_hash = db.session.execute(sql, { "id": id }).fetchone()
+
+    if content_hash:
+        # the files can be shared with other uploads of the same file, so they're only removed with the last video using them
+        sql = text("UPDATE video_assets SET refcount=refcount-1 WHERE hash=:hash RETURNING refcount")
+        if db.session.execute(sql, { "hash": content_hash }).scalar() > 0:
+            folder = None
+        else:
+            db.session.execute(text("DELETE FROM video_assets WHERE hash=:hash"), { "hash": content_hash })
+
+    if folder:
+        # the folder is removed by the worker after this commits, so the files are never gone while the video isn't
+        sql = text("INSERT INTO deleted_folders (folder) VALUES (:folder) ON CONFLICT (folder) DO NOTHING")
+        db.session.execute(sql, { "folder": folder })
 
     db.session.commit()
 
+    view_count.delete_viewers(id)
+    trending.remove(id)
+    feed_cache.invalidate()
+
     return "OK"
 
 
+@blueprint.route("/api/video/<id>/viewers")
+@auth.requires_auth()
+def get_viewers(user: auth.User, id: str):
+    if not is_owner(id, user):
+        return helpers.create_error("You don't own this video"), 403
+
+    try:
+        days = int(request.args.get("days") or 7)
+    except ValueError:
+        return helpers.create_error("\"days\" should be a number"), 400
+
+    return view_count.viewer_stats(id, days)
+
+
 class VideoUpdateAction(str, Enum):
     set_private = "set_private"
     set_public = "set_public"
@@ -60,12 +126,10 @@ def modify_video(user: auth.User, id: str):
 
 
 @blueprint.route("/api/video/<video_id>/comment", methods=["POST"])
-@auth.requires_auth()
+@auth.requires_auth(persistent=True)
 @helpers.requires_form_data({ "content": str })
 def post_comment(user: auth.User, video_id: str):
-    sql = text("INSERT INTO comments (owner, video, content) VALUES (:owner, :video, :content)")
-    db.session.execute(sql, { "owner": user.uid, "video": video_id, "content": request.form.get("content") })
-    db.session.commit()
+    comments.post_comment(user.uid, video_id, request.form.get("content"))
 
     return "OK"
 
@@ -73,13 +137,7 @@ def post_comment(user: auth.User, video_id: str):
 @blueprint.route("/api/video/<video_id>/comments")
 @auth.requires_auth()
 def get_comments(user: auth.User, video_id: str):
-    sql = text("""SELECT U.username, C.content FROM comments C
-               JOIN users U on U.uid=C.owner
-               WHERE video=:video""")
-    comments = db.session.execute(sql, { "video": video_id }).mappings().fetchall()
-    comments = [dict(comment) for comment in comments]
-
-    return comments
+    return comments.get_comments(video_id)
 
 
 @blueprint.route("/api/videos")
@@ -96,30 +154,128 @@ def list_videos(user: auth.User):
     except ValueError:
         return { "error": { "message": "missing arg offset" } }, 400
 
+    # page size is capped, so a single request can't ask for every video at once
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    if "trending" in request.args:
+        # the order comes from the trending sorted set, the database only fills in the videos on the page
+        video_ids = trending.get_page(limit, offset)
+        sql = text(TRENDING_PAGE_SQL)
+        videos = db.session.execute(sql, { "video_ids": video_ids }).mappings().fetchall()
+        return { "base_url": BASE_URL, "videos": [dict(video) for video in videos] }
+
+    cursor = None
+    if "cursor" in request.args:
+        cursor = decode_cursor(request.args["cursor"])
+        if not cursor:
+            return { "error": { "message": "invalid arg cursor" } }, 400
+
     if "public" in request.args:
-        sql = text("""SELECT V.id, V.views, V.duration, V.title, U.username AS owner FROM videos V
-                   JOIN users U ON U.uid=V.owner
-                   WHERE V.owner!=:owner AND V.private=false
-                   ORDER BY V.upload_date DESC
-                   LIMIT(:limit) OFFSET(:offset*:limit);""")
-    else:
-        sql = text("""SELECT id, views, duration, title, private
-                   FROM videos WHERE owner=:owner
-                   ORDER BY upload_date DESC
-                   LIMIT(:limit) OFFSET(:offset*:limit);""")
-    videos = db.session.execute(sql, { "owner": user.uid, "limit": limit, "offset": offset }).mappings().fetchall()
+        # the cached page is the same for every user, their own videos are left out after it's loaded
+        page = feed_cache.get_page(f"{request.args.get('cursor', '')}:{offset}:{limit}",
+                                   lambda: load_public_page(limit, offset, cursor))
+        videos = [video for video in page["videos"] if video.pop("owner_uid") != user.uid]
+        return { "base_url": BASE_URL, "videos": videos, "next_cursor": page["next_cursor"] }
+
+    sql = text(OWN_PAGE_SQL.format(after_cursor=after_cursor(cursor)))
+    videos = db.session.execute(sql, {
+        "owner": user.uid,
+        "limit": limit,
+        "offset": 0 if cursor else offset,
+        "cursor_date": cursor and cursor[0],
+        "cursor_id": cursor and cursor[1]
+    }).mappings().fetchall()
+
+    return { "base_url": BASE_URL, **paginate([dict(video) for video in videos], limit) }
+
+
+def load_public_page(limit: int, offset: int, cursor: tuple[datetime, str] | None):
+    sql = text(PUBLIC_PAGE_SQL.format(after_cursor=after_cursor(cursor)))
+    videos = db.session.execute(sql, {
+        "limit": limit,
+        "offset": 0 if cursor else offset,
+        "cursor_date": cursor and cursor[0],
+        "cursor_id": cursor and cursor[1]
+    }).mappings().fetchall()
+
+    return paginate([dict(video) for video in videos], limit)
+
+
+# with a cursor the page starts right after the video the cursor points to, found from the index without walking
+# through the earlier pages, offset is still supported for older clients
+def after_cursor(cursor: tuple[datetime, str] | None):
+    return "AND (V.upload_date, V.id) < (:cursor_date, :cursor_id)" if cursor else ""
+
+
+# one video more than the limit is fetched, to know if there's a next page
+def paginate(videos: list[dict], limit: int):
+    next_cursor = None
+    if len(videos) > limit:
+        videos = videos[:limit]
+        next_cursor = encode_cursor(videos[-1]["upload_date"], videos[-1]["id"])
+    for video in videos:
+        video.pop("upload_date")
+
+    return { "videos": videos, "next_cursor": next_cursor }
+
+
+@blueprint.route("/api/search")
+@auth.requires_auth()
+def search_videos(user: auth.User):
+    # words are matched as prefixes, everything else in the query is ignored so it can't break the tsquery syntax
+    words = re.findall(r"\w+", request.args.get("q") or "")
+    if not words:
+        return { "error": { "message": "missing arg q" } }, 400
+    try:
+        limit = max(1, min(int(request.args.get("limit") or 20), MAX_PAGE_SIZE))
+        offset = max(0, int(request.args.get("offset") or 0))
+    except ValueError:
+        return { "error": { "message": "invalid arg limit or offset" } }, 400
+
+    sql = text(SEARCH_SQL)
+    videos = db.session.execute(sql, {
+        "q": " ".join(words),
+        "tsquery": " & ".join(f"{word}:*" for word in words),
+        "owner": user.uid,
+        "limit": limit,
+        "offset": offset
+    }).mappings().fetchall()
     videos = [dict(video) for video in videos]
+    for video in videos:
+        video.pop("rank")
 
-    return { "base_url": BASE_URL, "videos": list(videos) }
+    # one video more than the limit is fetched, to know if there's a next page
+    return {
+        "base_url": BASE_URL,
+        "videos": videos[:limit],
+        "next_offset": offset + 1 if len(videos) > limit else None
+    }
+
+
+# cursors are opaque to clients, they're the upload date and id of the last video of the previous page
+def encode_cursor(upload_date: datetime, video_id: str):
+    return urlsafe_b64encode(json.dumps([upload_date.isoformat(), video_id]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, str] | None:
+    try:
+        upload_date, video_id = json.loads(urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(upload_date), str(video_id)
+    except (ValueError, TypeError):
+        return None
 
 
 def set_private(video_id: str, private: bool):
     sql = text("UPDATE videos SET private=:private WHERE id=:id")
     db.session.execute(sql, { "id": video_id, "private": private })
     db.session.commit()
+    feed_cache.invalidate()
+
+    if private:
+        trending.remove(video_id)
 
 
 def is_owner(video_id: str, user: auth.User):
-    sql = text("SELECT * FROM videos WHERE id=:id AND owner=:user_id")
+    sql = text(IS_OWNER_SQL)
     result = db.session.execute(sql, { "id": video_id, "user_id": user.uid }).fetchone()
     return result is not None
@@ -2,12 +2,44 @@ from flask import session, request
 from uuid import uuid4
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import text
-from datetime import datetime
-from .auth import User
+from datetime import datetime, timedelta, timezone
+import threading
+from redis import Redis, ResponseError
+from .auth import User, persist_user
+from . import trending, heartbeat
+from .config import IS_DEV, VIEW_FLUSH_BATCH_SIZE, VIEW_COUNT_MODE, VIEW_COUNT_AUDIT, VIEW_DAILY_EXPIRY_DAYS
 
 db: SQLAlchemy = None
 
 
+BUFFER_KEY = "view_buffer"
+# the buffer is moved here while it's written to the database, one per worker process like the transcode processing list
+FLUSHING_KEY = "view_buffer_flushing:{worker}"
+
+# HyperLogLogs of everyone who has viewed a video, and of who viewed it on a day
+VIEWERS_KEY = "viewers:{video_id}"
+DAILY_VIEWERS_KEY = "viewers:{video_id}:{day}"
+# videos with new viewers since the last flush, and the estimate each video's views column was last updated to
+TOUCHED_KEY = "viewers_touched"
+TOUCHED_FLUSHING_KEY = "viewers_touched_flushing:{worker}"
+COUNTED_KEY = "viewers_counted"
+# merged daily estimates are kept this long (seconds), so repeated requests for the same range don't merge again
+ROLLUP_EXPIRY = 60
+
+# the estimates need redis, so dev environment always counts exactly
+USE_HLL = VIEW_COUNT_MODE == "hll" and not IS_DEV
+
+
+if not IS_DEV:
+    redis = Redis(db=3)
+
+
+# redis isn't used in dev environment, so there views are buffered in the web server process
+# dictionary from (video id, user id) to how many times the user viewed the video since the last flush
+view_buffer: dict[tuple[str, int], int] = {}
+view_buffer_lock = threading.Lock()
+
+
 def begin_view(video_id: str):
     view_id = uuid4()
 
@@ -42,24 +74,256 @@ def process_view(video_id: str, user: User):
     except ValueError:
         return
 
+    # the view is what saves an anonymous visitor to the database, visitors who never watch anything aren't saved
+    user = persist_user(user)
+    if not user:
+        return
+
+    if USE_HLL:
+        add_viewer(video_id, user.uid)
+    if not USE_HLL or VIEW_COUNT_AUDIT:
+        # the view is only buffered here, the worker writes buffered views to the database in batches with flush_views
+        buffer_views({ (video_id, user.uid): 1 })
+
+    # remove view from session
+    session.pop("v")
+
+
+def add_viewer(video_id: str, user_id: int):
+    daily_key = DAILY_VIEWERS_KEY.format(video_id=video_id, day=today())
+
+    pipeline = redis.pipeline()
+    pipeline.pfadd(VIEWERS_KEY.format(video_id=video_id), user_id)
+    pipeline.pfadd(daily_key, user_id)
+    pipeline.expire(daily_key, VIEW_DAILY_EXPIRY_DAYS * 24 * 60 * 60)
+    pipeline.sadd(TOUCHED_KEY, video_id)
+    pipeline.execute()
+
+
+def buffer_views(views: dict[tuple[str, int], int]):
+    if IS_DEV:
+        with view_buffer_lock:
+            for key, count in views.items():
+                view_buffer[key] = view_buffer.get(key, 0) + count
+        return
+
+    pipeline = redis.pipeline()
+    for (video_id, user_id), count in views.items():
+        pipeline.hincrby(BUFFER_KEY, f"{video_id}:{user_id}", count)
+    pipeline.execute()
+
+
+# writes the buffered views to the database, ran periodically by the worker
+def flush_views():
+    if USE_HLL:
+        flush_viewer_estimates()
+    if IS_DEV:
+        with view_buffer_lock:
+            views = dict(view_buffer)
+            view_buffer.clear()
+    else:
+        flushing_key = FLUSHING_KEY.format(worker=heartbeat.worker_id())
+        try:
+            # the buffer is renamed, so views coming in while it's written go to a new buffer
+            redis.rename(BUFFER_KEY, flushing_key)
+        except ResponseError:
+            # nothing buffered
+            return
+        views = load_views(flushing_key)
+
+    # sorted, so concurrent flushes lock the rows in the same order
+    items = sorted(views.items())
+    written = 0
+    viewers = {}
     try:
-        sql = text("SELECT count FROM views WHERE video_id=:video_id AND user_id=:user_id;")
-        response = db.session.execute(sql, { "video_id": video_id, "user_id": user.uid }).fetchone()
-
-        if not response:
-            # user hasn't viewed the video before
-            sql = text("INSERT INTO views (video_id, user_id, count) VALUES (:video_id, :user_id, 0);")
-            db.session.execute(sql, { "video_id": video_id, "user_id": user.uid })
-            sql = text("UPDATE videos SET views=views+1 WHERE id=:video_id;")
-            db.session.execute(sql, { "video_id": video_id, })
-        else:
-            # user has viewed the video before
-            sql = text("UPDATE views SET count=count+1 WHERE video_id=:video_id AND user_id=:user_id;")
-            db.session.execute(sql, { "video_id": video_id, "user_id": user.uid })
-
-        db.session.commit()
-
-        # remove view from session
-        session.pop("v")
-    except Exception as e:
-        print(e)
+        for i in range(0, len(items), VIEW_FLUSH_BATCH_SIZE):
+            # a video's viewers can be split over several batches
+            for video_id, count in write_views(items[i:i + VIEW_FLUSH_BATCH_SIZE]).items():
+                viewers[video_id] = viewers.get(video_id, 0) + count
+            written = i + VIEW_FLUSH_BATCH_SIZE
+    except Exception:
+        db.session.rollback()
+        # put the unwritten views back in the buffer, so they're written on the next flush
+        buffer_views(dict(items[written:]))
+        raise
+    finally:
+        if not IS_DEV:
+            redis.delete(flushing_key)
+        # the batches written before a failure are committed, so their viewers count for trending too
+        trending.add_viewers(viewers)
+
+
+# adds the growth of each touched video's viewer estimate to its views column
+def flush_viewer_estimates():
+    touched_flushing_key = TOUCHED_FLUSHING_KEY.format(worker=heartbeat.worker_id())
+    try:
+        redis.rename(TOUCHED_KEY, touched_flushing_key)
+    except ResponseError:
+        # no new viewers
+        return
+
+    video_ids = sorted(video_id.decode() for video_id in redis.smembers(touched_flushing_key))
+    viewers = {}
+    try:
+        for i in range(0, len(video_ids), VIEW_FLUSH_BATCH_SIZE):
+            batch = video_ids[i:i + VIEW_FLUSH_BATCH_SIZE]
+
+            pipeline = redis.pipeline()
+            for video_id in batch:
+                pipeline.pfcount(VIEWERS_KEY.format(video_id=video_id))
+            estimates = pipeline.execute()
+            counted = [int(count or 0) for count in redis.hmget(COUNTED_KEY, batch)]
+
+            sql = text("""UPDATE videos SET views=views + E.viewers
+                       FROM unnest(CAST(:video_ids AS text[]), CAST(:viewers AS integer[])) AS E(video_id, viewers)
+                       WHERE videos.id=E.video_id AND E.viewers > 0
+                       RETURNING videos.id, E.viewers, videos.private;""")
+            result = db.session.execute(sql, {
+                "video_ids": batch,
+                "viewers": [estimate - count for estimate, count in zip(estimates, counted)]
+            }).fetchall()
+            db.session.commit()
+            viewers.update({ video_id: count for video_id, count, private in result if not private })
+
+            redis.hset(COUNTED_KEY, mapping={ video_id: max(estimate, count) for video_id, estimate, count in zip(batch, estimates, counted) })
+    except Exception:
+        db.session.rollback()
+        # the videos are counted again on the next flush
+        redis.sadd(TOUCHED_KEY, *video_ids)
+        raise
+    finally:
+        redis.delete(touched_flushing_key)
+        trending.add_viewers(viewers)
+
+
+# puts views left over from flushes of worker processes that died back in the buffer, ran when a worker starts and
+# periodically after that. a leftover is read and deleted in one transaction, so only one worker puts it back
+def requeue_unflushed():
+    if IS_DEV:
+        return
+    for key in redis.scan_iter(FLUSHING_KEY.format(worker="*")):
+        if heartbeat.is_alive(key.decode().split(":", 1)[1]):
+            continue
+        pipeline = redis.pipeline()
+        pipeline.hgetall(key)
+        pipeline.delete(key)
+        views = parse_views(pipeline.execute()[0])
+        if views:
+            buffer_views(views)
+
+    for key in redis.scan_iter(TOUCHED_FLUSHING_KEY.format(worker="*")):
+        if heartbeat.is_alive(key.decode().split(":", 1)[1]):
+            continue
+        pipeline = redis.pipeline()
+        pipeline.smembers(key)
+        pipeline.delete(key)
+        touched = pipeline.execute()[0]
+        if touched:
+            redis.sadd(TOUCHED_KEY, *touched)
+
+
+def load_views(key: str) -> dict[tuple[str, int], int]:
+    return parse_views(redis.hgetall(key))
+
+
+def parse_views(buffered: dict[bytes, bytes]) -> dict[tuple[str, int], int]:
+    views = {}
+    for field, count in buffered.items():
+        video_id, user_id = field.decode().rsplit(":", 1)
+        views[(video_id, int(user_id))] = int(count)
+    return views
+
+
+# one upsert for the whole batch, a user's first view of a video inserts a row with count 0 and adds to videos.views,
+# later views add to the count of the row (like count=count+1 did before, once per view)
+WRITE_VIEWS_SQL = """WITH buffered AS (
+                   SELECT * FROM unnest(CAST(:video_ids AS text[]), CAST(:user_ids AS integer[]), CAST(:counts AS integer[]))
+                       AS B(video_id, user_id, count)
+                   -- views of videos or users deleted while the views were buffered are dropped
+                   WHERE EXISTS (SELECT 1 FROM videos V WHERE V.id=B.video_id)
+                   AND EXISTS (SELECT 1 FROM users U WHERE U.uid=B.user_id)
+               ), upserted AS (
+                   INSERT INTO views (video_id, user_id, count)
+                   SELECT video_id, user_id, count - 1 FROM buffered
+                   ON CONFLICT (video_id, user_id) DO UPDATE SET count=views.count + EXCLUDED.count + 1
+                   -- xmax is 0 for inserted rows, so this tells new viewers apart from returning ones
+                   RETURNING video_id, (xmax = 0) AS inserted
+               )
+               UPDATE videos SET views=views + N.viewers
+               FROM (SELECT video_id, count(*) AS viewers FROM upserted WHERE inserted GROUP BY video_id) AS N
+               -- in "hll" mode views are counted from the estimates, the table is only written for auditing
+               WHERE videos.id=N.video_id AND NOT :use_hll
+               RETURNING videos.id, N.viewers, videos.private;"""
+
+
+# returns how many new viewers each public video got, for the trending feed
+def write_views(batch: list[tuple[tuple[str, int], int]]) -> dict[str, int]:
+    sql = text(WRITE_VIEWS_SQL)
+    result = db.session.execute(sql, {
+        "video_ids": [video_id for (video_id, _), _ in batch],
+        "user_ids": [user_id for (_, user_id), _ in batch],
+        "counts": [count for _, count in batch],
+        "use_hll": USE_HLL
+    }).fetchall()
+    db.session.commit()
+
+    return { video_id: viewers for video_id, viewers, private in result if not private }
+
+
+TOTAL_VIEWS_SQL = "SELECT views FROM videos WHERE id=:id"
+AUDIT_VIEWERS_SQL = "SELECT count(*) FROM views WHERE video_id=:id"
+
+
+# unique viewers of a video: the total, and in "hll" mode estimates for each of the last days and all of them together
+def viewer_stats(video_id: str, days: int):
+    total = db.session.execute(text(TOTAL_VIEWS_SQL), { "id": video_id }).scalar()
+    if not USE_HLL:
+        return { "mode": "exact", "total": total }
+
+    days = max(1, min(days, VIEW_DAILY_EXPIRY_DAYS))
+    day_keys = [DAILY_VIEWERS_KEY.format(video_id=video_id, day=day) for day in last_days(days)]
+
+    pipeline = redis.pipeline()
+    pipeline.pfcount(VIEWERS_KEY.format(video_id=video_id))
+    for key in day_keys:
+        pipeline.pfcount(key)
+    estimate, *daily = pipeline.execute()
+
+    rollup_key = f"viewers:{video_id}:last:{today()}:{days}"
+    if not redis.exists(rollup_key):
+        redis.pfmerge(rollup_key, *day_keys)
+        redis.expire(rollup_key, ROLLUP_EXPIRY)
+
+    stats = {
+        "mode": "hll",
+        "total": total,
+        "estimate": estimate,
+        "days": [{ "day": day, "viewers": viewers } for day, viewers in zip(last_days(days), daily)],
+        "range": redis.pfcount(rollup_key)
+    }
+
+    if VIEW_COUNT_AUDIT:
+        sql = text(AUDIT_VIEWERS_SQL)
+        stats["exact"] = db.session.execute(sql, { "id": video_id }).scalar()
+
+    return stats
+
+
+# removes the viewer estimates of a deleted video
+def delete_viewers(video_id: str):
+    if not USE_HLL:
+        return
+    redis.delete(VIEWERS_KEY.format(video_id=video_id),
+                 *[DAILY_VIEWERS_KEY.format(video_id=video_id, day=day) for day in last_days(VIEW_DAILY_EXPIRY_DAYS)])
+    redis.hdel(COUNTED_KEY, video_id)
+
+
+# days are in UTC, so every web server and worker agrees on them
+def today():
+    return datetime.now(timezone.utc).date().isoformat()
+
+
+# the last days, newest first
+def last_days(days: int):
+    now = datetime.now(timezone.utc).date()
+    return [(now - timedelta(days=i)).isoformat() for i in range(days)]
@@ -0,0 +1,94 @@
+from dataclasses import replace
+import threading
+from time import sleep, perf_counter
+from typing import Callable
+from flask import Flask
+from src import file_upload, transcode_queue, view_count, cleanup, metrics, heartbeat
+from src.config import TRANSCODE_CONCURRENCY, TRANSCODE_MAX_ATTEMPTS, VIEW_FLUSH_INTERVAL, DELETE_INTERVAL, RECONCILE_INTERVAL, \
+    REAP_INTERVAL, WORKER_METRICS_PORT
+
+
+# runs the worker in the current process until it's stopped, used by the "flask worker" command
+def run(app: Flask):
+    # this process is marked alive first, so other workers starting at the same time leave its work alone
+    heartbeat.beat()
+    requeue_abandoned()
+    if WORKER_METRICS_PORT:
+        metrics.serve(WORKER_METRICS_PORT)
+    for thread in start(app):
+        thread.join()
+
+
+# starts the transcode threads and periodic tasks in the background
+# in dev environment these run inside the web server process, since there is no redis to share the queue through
+def start(app: Flask):
+    threads = []
+    for i in range(TRANSCODE_CONCURRENCY):
+        thread = threading.Thread(target=transcode_loop, args=(app,), name=f"transcode-{i}", daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    threads.append(start_periodic(app, "heartbeat", heartbeat.INTERVAL, heartbeat.beat))
+    threads.append(start_periodic(app, "requeue-abandoned", heartbeat.EXPIRY, requeue_abandoned))
+    threads.append(start_periodic(app, "flush-views", VIEW_FLUSH_INTERVAL, view_count.flush_views))
+    threads.append(start_periodic(app, "purge-deleted", DELETE_INTERVAL, cleanup.purge_deleted_folders))
+    threads.append(start_periodic(app, "reconcile", RECONCILE_INTERVAL, cleanup.reconcile))
+    threads.append(start_periodic(app, "reap-expired", REAP_INTERVAL, cleanup.reap_expired))
+    return threads
+
+
+# puts back what worker processes that died were in the middle of, a process counts as dead once its heartbeat expires
+def requeue_abandoned():
+    transcode_queue.requeue_unfinished()
+    view_count.requeue_unflushed()
+
+
+def start_periodic(app: Flask, name: str, interval: float, task: Callable[[], object]):
+    thread = threading.Thread(target=periodic_loop, args=(app, interval, task), name=name, daemon=True)
+    thread.start()
+    return thread
+
+
+def periodic_loop(app: Flask, interval: float, task: Callable[[], object]):
+    with app.app_context():
+        while True:
+            sleep(interval)
+            start = perf_counter()
+            try:
+                task()
+            except Exception:
+                app.logger.exception(f"Periodic task {task.__name__} failed")
+                metrics.task_failures.labels(task=task.__name__).inc()
+            metrics.task_duration.labels(task=task.__name__).observe(perf_counter() - start)
+
+
+def transcode_loop(app: Flask):
+    with app.app_context():
+        while True:
+            job = transcode_queue.dequeue()
+            if job:
+                process_job(app, job)
+
+
+def process_job(app: Flask, job: transcode_queue.TranscodeJob):
+    metrics.transcodes_running.inc()
+    try:
+        # a job retried after its video was saved (something after the insert failed) only finishes saving it,
+        # the files are already being served so they aren't transcoded again
+        if not file_upload.video_exists(job.video_id):
+            file_upload.transcode(job)
+        file_upload.after_transcode(job)
+        metrics.transcodes.labels(result="done").inc()
+    except Exception:
+        app.logger.exception(f"Transcoding video {job.video_id} failed (attempt {job.attempts + 1})")
+        file_upload.db.session.rollback()
+        metrics.transcodes.labels(result="failed").inc()
+
+        if job.attempts + 1 < TRANSCODE_MAX_ATTEMPTS:
+            file_upload.reset_transcode_progress(job.video_id)
+            transcode_queue.enqueue(replace(job, attempts=job.attempts + 1))
+        else:
+            file_upload.transcode_failed(job.video_id)
+    finally:
+        metrics.transcodes_running.dec()
+        transcode_queue.complete(job)
@@ -39,11 +39,13 @@ function showError(message) {
 }
 
 
+// uploads are sent in chunks of this size, so a dropped connection only loses the chunk being sent
+const UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024;
+
+
 class Upload {
-    /**@type {FormData} @readonly*/
-    formData;
-    /**@type {XMLHttpRequest} @readonly*/
-    xhr;
+    /**@type {File} @readonly*/
+    file;
     /**@type {HTMLDivElement} @readonly*/
     videoDiv;
     /**@type {HTMLDivElement} @readonly*/
@@ -56,12 +58,15 @@ class Upload {
     thumbnailVideo;
     /**@type {boolean} @readonly*/
     valid;
+    /**@type {string} @readonly*/
+    videoId;
+    /**@type {string} @readonly*/
+    folder;
     constructor(/**@type {File}*/ file) {
         if (!file.type.includes("video/")) return this.invalid("File is not a video.");
         if (file.size > 500 * 1024 * 1024) return this.invalid("File is too big. (>500MB)");
         this.valid = true;
-        this.formData = new FormData(); 
-        this.formData.append("file", file, file.name);
+        this.file = file;
         this.videoDiv = document.getElementById("videotemplate").content.cloneNode(true).querySelector("div.videobox");
         this.progressText = this.videoDiv.querySelector("div.progress-text");
         this.progressBar = this.videoDiv.querySelector("div.progress-bar");
@@ -87,13 +92,60 @@ class Upload {
         this.valid = false;
         showError(reason);
     }
-    send() {
-        const myself = this;
-        this.xhr = new XMLHttpRequest();
-        this.xhr.open("POST", "/api/upload");
-        this.xhr.upload.onprogress = event => { myself.progress(Math.round(event.loaded / event.total * 100)) };
-        this.xhr.onload = event => { myself.uploadDone(event) };
-        this.xhr.send(this.formData);
+    async send() {
+        try {
+            const formData = new FormData();
+            formData.append("filename", this.file.name);
+            formData.append("size", this.file.size);
+            const upload = await (await fetch("/api/upload/init", { method: "POST", body: formData })).json();
+            if (upload.error) return showError(upload.error);
+
+            let offset = 0;
+            let retries = 0;
+            while (offset < this.file.size) {
+                const result = await this.sendChunk(upload.upload_id, offset);
+                if (result.offset !== undefined) {
+                    // the server tells where to continue from, also when it was out of sync with what was sent
+                    offset = result.offset;
+                    retries = 0;
+                    continue;
+                }
+                if (!result.retry) return showError(result.error);
+                if (++retries > 5) return showError("Upload failed, connection lost.");
+
+                // connection dropped, wait a bit and ask the server how much of the file it got
+                await new Promise(resolve => setTimeout(resolve, 1000 * retries));
+                const status = await (await fetch(`/api/upload/${upload.upload_id}`)).json();
+                if (status.offset !== undefined) offset = status.offset;
+            }
+
+            const response = await (await fetch(`/api/upload/${upload.upload_id}/finalize`, { method: "POST" })).json();
+            this.uploadDone(response);
+        }
+        catch {
+            return showError("Upload error");
+        }
+    }
+    /**
+     * @private
+     * @returns {Promise<{ offset?: number, error?: string, retry?: boolean }>}
+     */
+    sendChunk(/**@type {string}*/ uploadId, /**@type {number}*/ offset) {
+        return new Promise(resolve => {
+            const xhr = new XMLHttpRequest();
+            xhr.open("PUT", `/api/upload/${uploadId}?offset=${offset}`);
+            xhr.upload.onprogress = event => { this.progress(Math.round((offset + event.loaded) / this.file.size * 100)) };
+            xhr.onload = () => {
+                try {
+                    resolve(JSON.parse(xhr.responseText));
+                }
+                catch {
+                    resolve({ retry: true });
+                }
+            };
+            xhr.onerror = () => resolve({ retry: true });
+            xhr.send(this.file.slice(offset, offset + UPLOAD_CHUNK_SIZE));
+        });
     }
     /** @private */
     progress(/**@type {Number}*/ progress) {
@@ -101,18 +153,14 @@ class Upload {
         this.progressStatus.innerText = progress + "%";
     }
     /** @private */
-    async uploadDone(/**@type {ProgressEvent<EventTarget>}*/ event) {
-        console.log(event)
+    async uploadDone(/**@type {{ video_id: string, folder: string, duration: number } | { error: string }}*/ response) {
         this.progressText.innerText = "Converting...";
         try {
-            const response = JSON.parse(this.xhr.responseText);
             if (response.error) {
-                return showError(response.error.message);
+                return showError(response.error);
             }
-            window.URL.revokeObjectURL(this.thumbnailVideo.src);
-            this.thumbnailVideo.style.display = "none";
-            this.videoDiv.querySelector("img.thumb").style.display = "";
-            this.videoDiv.querySelector("img.thumb").src = `/video_data/${response.video_id}/thumbnail-lowres.png`;
+            this.videoId = response.video_id;
+            this.folder = response.folder;
             //this.videoDiv.querySelector("a.link").innerText = `${document.location.origin}/v/${response.video_id}`
             //this.videoDiv.querySelector("a.link").href = `${document.location.origin}/v/${response.video_id}`
             this.videoDiv.querySelector("div.duration").innerText = secondsToVideoLenght(response.duration);
@@ -120,20 +168,26 @@ class Upload {
             this.videoDiv.querySelector("button.delete").style.display = "";
             this.videoDiv.querySelector("button.delete").onclick = event => deleteVideo(event, response.video_id)
             
-            while (true) {
-                const res = await (await fetch(`/api/progress/${response.video_id}`)).json();
-                if (res.error) {
-                    return showError(res.error.message);
-                }
-                this.progress(Math.round(res.progress));
-
-                if (res.progress == 100) {
-                    this.done();
-                    break;
-                }
-                
-                await new Promise(resolve => setTimeout(resolve, 200));
+            // the server pushes progress until the transcode is done or has failed
+            const result = await new Promise(resolve => {
+                const events = new EventSource(`/api/progress/${response.video_id}/events`);
+                events.onmessage = event => {
+                    const res = JSON.parse(event.data);
+                    if (res.error || res.progress == 100) {
+                        events.close();
+                        return resolve(res);
+                    }
+                    this.progress(Math.round(res.progress));
+                };
+                events.onerror = () => {
+                    // EventSource reconnects by itself, unless the connection can't be made at all
+                    if (events.readyState == EventSource.CLOSED) resolve({ error: "Lost connection to server" });
+                };
+            });
+            if (result.error) {
+                return showError(result.error);
             }
+            this.done();
 
             this.videoDiv.querySelector("button.private").style.display = "";
             this.videoDiv.querySelector("button.private").onclick = event => privateVideo(this.videoDiv, response.video_id)
@@ -145,6 +199,11 @@ class Upload {
     /** @private */
     done() {
         this.videoDiv.querySelector("div.progress-wrp").style.display = "none";
+        // the thumbnail is generated by the transcode worker, so it only exists once transcoding is done
+        window.URL.revokeObjectURL(this.thumbnailVideo.src);
+        this.thumbnailVideo.style.display = "none";
+        this.videoDiv.querySelector("img.thumb").style.display = "";
+        this.videoDiv.querySelector("img.thumb").src = `/thumbnail/${this.folder}?w=376`;
     }
 }
 
@@ -219,7 +278,7 @@ async function privateVideo(/**@type {HTMLDivElement}*/ videoDiv, /**@type {stri
 }
 
 /**
- * @typedef {{ id: string, title: string, owner: string, duration: Number, views: Number, private?: boolean }} Video
+ * @typedef {{ id: string, folder: string, title: string, owner: string, duration: Number, views: Number, private?: boolean }} Video
  * @typedef {{ base_url: string, videos: Video[] } | { error: { message: string } }} VideosResponse
  */
 
@@ -235,7 +294,7 @@ async function loadVideos(/**@type {boolean}*/ public) {
         for (const video of response.videos) {
             const videoDiv = document.getElementById("videotemplate").content.cloneNode(true).querySelector("div.videobox");
             videoDiv.querySelector("div.progress-wrp").style.display = "none";
-            videoDiv.querySelector("img.thumb").src = `/video_data/${video.id}/thumbnail-lowres.png`;
+            videoDiv.querySelector("img.thumb").src = `/thumbnail/${video.folder}?w=376`;
             videoDiv.querySelector("span.title").innerText = video.title;
             videoDiv.querySelector("div.duration").innerText = secondsToVideoLenght(video.duration);
             if (public) {
@@ -7,8 +7,10 @@ async function onLoad() {
     window.onresize = () => { document.querySelector("div#comments").style.width = window.getComputedStyle(document.querySelector("video")).width.replace("px", "") - 20 + "px"; }
     window.onresize();
     loadComments();
+    setInterval(refreshComments, 30000);
 
     const video = document.querySelector("video");
+    loadVideo(video);
     let lastT = 0;
     while (true) {
         let t = video.duration < 15 ? 15 - video.duration : 0;
@@ -20,28 +22,73 @@ async function onLoad() {
         await new Promise(resolve => setTimeout(resolve, 4000));
     }
 }
-async function loadComments() {
+function loadVideo(/**@type {HTMLVideoElement}*/ video) {
+    const manifest = video.dataset.hls;
+    if (!manifest) return;
+    // safari plays hls natively, other browsers need hls.js
+    if (video.canPlayType("application/vnd.apple.mpegurl") || !window.Hls || !Hls.isSupported()) {
+        video.src = manifest;
+        return;
+    }
+    const hls = new Hls();
+    hls.loadSource(manifest);
+    hls.attachMedia(video);
+}
+/**
+ * @typedef {{ id: number, username: string, content: string }} Comment
+ * @typedef {{ comments: Comment[], count: number, next_cursor: number | null, truncated: boolean }} CommentsPage
+ */
+
+// id of the newest comment shown, newer ones are fetched with "since"
+let newestCommentId = 0;
+
+async function loadComments(/**@type {number | null}*/ cursor = null) {
     // wait until auth has gotten a user (i know this is a dumb way but it works)
     while (!window.user) await new Promise(resolve => setTimeout(resolve, 500));
 
-    /**@type { { owner: string, content: string }[] } */
-    const comments = await (await fetch(`/api/video/${videoId}/comments`)).json()
+    /**@type {CommentsPage} */
+    const page = await (await fetch(`/api/video/${videoId}/comments` + (cursor ? `?cursor=${cursor}` : ""))).json()
 
-    document.querySelector("#comments-title").innerText = `${comments.length} Comments`;
+    document.querySelector("#comments-title").innerText = `${page.count} Comments`;
+    if (!cursor && page.comments.length) newestCommentId = page.comments[0].id;
 
-    const commentTemplate = document.querySelector("template#comment")
-    const commentsElem = document.querySelector("div#comments")
+    const moreButton = document.querySelector("button#more-comments");
+    for (const comment of page.comments) {
+        moreButton.insertAdjacentElement("beforebegin", createComment(comment));
+    }
+
+    moreButton.style.display = page.next_cursor ? "" : "none";
+    moreButton.onclick = () => loadComments(page.next_cursor);
+}
 
-    for (const comment of comments) {
-        const commentDiv = commentTemplate.content.cloneNode(true).querySelector("div.comment");
+// adds comments posted after the page was loaded to the top
+async function refreshComments() {
+    /**@type {CommentsPage} */
+    const page = await (await fetch(`/api/video/${videoId}/comments?since=${newestCommentId}`)).json()
+    if (page.truncated) {
+        // too many new comments to fit on a page, start over from the first page
+        document.querySelectorAll("div#comments div.comment").forEach(comment => comment.remove());
+        return loadComments();
+    }
 
-        commentDiv.querySelector(".user").innerText = comment.username;
-        commentDiv.querySelector(".content").innerText = comment.content;
+    document.querySelector("#comments-title").innerText = `${page.count} Comments`;
+    if (page.comments.length) newestCommentId = page.comments[0].id;
 
-        commentsElem.appendChild(commentDiv)
+    const commentBox = document.querySelector("div.commentbox");
+    for (const comment of page.comments.reverse()) {
+        commentBox.insertAdjacentElement("afterend", createComment(comment));
     }
 }
 
+function createComment(/**@type {Comment}*/ comment) {
+    const commentDiv = document.querySelector("template#comment").content.cloneNode(true).querySelector("div.comment");
+
+    commentDiv.querySelector(".user").innerText = comment.username;
+    commentDiv.querySelector(".content").innerText = comment.content;
+
+    return commentDiv;
+}
+
 async function postComment() {
     const commentContent = document.querySelector("input#comment").value;
 
@@ -52,12 +99,8 @@ async function postComment() {
         return alert(result.error.message);
     }
 
-    const commentDiv = document.querySelector("template#comment").content.cloneNode(true).querySelector("div.comment");
-
-    commentDiv.querySelector(".user").innerText = window.user.username;
-    commentDiv.querySelector(".content").innerText = commentContent;
-
-    document.querySelector("div.commentbox").insertAdjacentElement("afterend", commentDiv);
+    document.querySelector("input#comment").value = "";
+    await refreshComments();
 }
 
 /** @returns {Promise<{ error?: AuthError }>} */
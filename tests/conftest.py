@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# the tests import the app's modules from the repository root, in the dev environment (no redis) with a sqlite
+# database and a video folder of their own, unless the environment says otherwise
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("ENVIRONMENT", "dev")
+os.environ.setdefault("SQLALCHEMY_DATABASE_URI", "sqlite://")
+os.environ.setdefault("VIDEO_FOLDER", tempfile.mkdtemp(prefix="videosite-test-"))
+os.environ.setdefault("THUMBNAIL_CACHE_FOLDER", tempfile.mkdtemp(prefix="videosite-test-thumbnails-"))
@@ -0,0 +1,48 @@
+from src import cache
+from src.cache import TTLCache
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(cache, "monotonic", lambda: now[0])
+    entries = TTLCache(10, 5)
+    entries.set("a", 1)
+
+    now[0] = 104
+    assert entries.get("a") == 1
+    now[0] = 106
+    assert entries.get("a") is None
+    assert entries.stats()["expirations"] == 1
+    assert len(entries) == 0
+
+
+def test_touch_restarts_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(cache, "monotonic", lambda: now[0])
+    entries = TTLCache(10, 5)
+    entries.set("a", 1)
+
+    now[0] = 104
+    assert entries.get("a", touch=True) == 1
+    now[0] = 108
+    assert entries.get("a") == 1
+
+
+def test_least_recently_used_is_evicted():
+    entries = TTLCache(2, 60)
+    entries.set("a", 1)
+    entries.set("b", 2)
+    entries.get("a")
+    entries.set("c", 3)
+
+    assert entries.peek("b") is None
+    assert entries.peek("a") == 1 and entries.peek("c") == 3
+    assert entries.stats()["evictions"] == 1
+
+
+def test_peek_does_not_count():
+    entries = TTLCache(2, 60)
+    entries.set("a", 1)
+    entries.peek("a")
+    entries.peek("b")
+    assert entries.stats()["hits"] == 0 and entries.stats()["misses"] == 0
@@ -0,0 +1,140 @@
+import hashlib
+import os
+import pytest
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import text
+from src import file_upload, video_metadata
+
+
+MP4_HEADER = b"\x00\x00\x00\x18ftypmp42" + b"\x00" * 500
+
+
+@pytest.mark.parametrize("header", [
+    MP4_HEADER,
+    b"\x1a\x45\xdf\xa3" + b"\x00" * 100,
+    b"RIFF\x00\x00\x00\x00AVI LIST",
+    b"FLV\x01",
+    b"OggS\x00",
+    b"\x47" + b"\x00" * 187 + b"\x47",
+])
+def test_video_containers_are_recognized(header):
+    assert file_upload.is_video_container(header)
+
+
+@pytest.mark.parametrize("header", [b"", b"\x89PNG\r\n\x1a\n", b"%PDF-1.7", b"RIFF\x00\x00\x00\x00WAVE", b"\x47" * 100])
+def test_other_files_are_not(header):
+    assert not file_upload.is_video_container(header)
+
+
+@pytest.fixture
+def app(monkeypatch):
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+    db = SQLAlchemy(app)
+    monkeypatch.setattr(file_upload, "db", db)
+    with app.app_context():
+        # only what generate_id looks at
+        db.session.execute(text("CREATE TABLE videos (id text, folder text)"))
+        db.session.execute(text("CREATE TABLE deleted_folders (folder text)"))
+        yield app
+
+
+def init(app: Flask, size: int):
+    with app.test_request_context(method="POST", data={ "filename": "video.mp4", "size": str(size) }):
+        return file_upload.init_upload(1)["upload_id"]
+
+
+def put(app: Flask, video_id: str, offset: int, data: bytes, owner: int = 1):
+    with app.test_request_context(f"/?offset={offset}", method="PUT", data=data):
+        return file_upload.write_chunk(owner, video_id)
+
+
+def test_chunks_are_appended_and_hashed(app):
+    data = MP4_HEADER + b"x" * 1000
+    video_id = init(app, len(data))
+
+    assert put(app, video_id, 0, data[:600]) == { "offset": 600 }
+    assert put(app, video_id, 600, data[600:]) == { "offset": len(data) }
+
+    upload = file_upload.load_pending_upload(video_id)
+    with open(file_upload.pending_upload_path(video_id, upload), "rb") as file:
+        assert file.read() == data
+    hasher, hashed = file_upload.upload_hashers[video_id]
+    assert hashed == len(data) and hasher.hexdigest() == hashlib.sha256(data).hexdigest()
+
+
+def test_wrong_offset_gets_current_offset(app):
+    video_id = init(app, 2000)
+    put(app, video_id, 0, MP4_HEADER)
+
+    body, status = put(app, video_id, 0, MP4_HEADER)
+    assert status == 409 and body["offset"] == len(MP4_HEADER)
+    body, status = put(app, video_id, 5000, b"x")
+    assert status == 409 and body["offset"] == len(MP4_HEADER)
+
+
+def test_other_users_upload_is_not_found(app):
+    video_id = init(app, 2000)
+    assert put(app, video_id, 0, MP4_HEADER, owner=2)[1] == 404
+
+
+def test_non_video_is_rejected_and_removed(app):
+    video_id = init(app, 2000)
+    _, status = put(app, video_id, 0, b"%PDF-1.7" + b"\x00" * 600)
+
+    assert status == 415
+    assert file_upload.load_pending_upload(video_id) is None
+    assert not os.path.exists(os.path.join(file_upload.VIDEO_FOLDER, video_id))
+
+
+def test_chunk_past_declared_size_is_dropped(app):
+    data = MP4_HEADER + b"x" * (file_upload.CHUNK_READ_SIZE + 5)
+    video_id = init(app, len(data))
+    put(app, video_id, 0, MP4_HEADER)
+
+    # the first read from the stream fits and is written, the size is only exceeded on the next one
+    body, status = put(app, video_id, len(MP4_HEADER), b"x" * (file_upload.CHUNK_READ_SIZE + 10))
+    assert status == 413 and body["offset"] == len(MP4_HEADER)
+    upload = file_upload.load_pending_upload(video_id)
+    assert os.path.getsize(file_upload.pending_upload_path(video_id, upload)) == len(MP4_HEADER)
+
+    # the upload goes on from where it was, with the hash still following it
+    assert put(app, video_id, len(MP4_HEADER), data[len(MP4_HEADER):]) == { "offset": len(data) }
+    hasher, hashed = file_upload.upload_hashers[video_id]
+    assert hashed == len(data) and hasher.hexdigest() == hashlib.sha256(data).hexdigest()
+
+
+def test_first_chunk_past_declared_size_is_not_written(app):
+    video_id = init(app, 100)
+
+    body, status = put(app, video_id, 0, MP4_HEADER)
+    assert status == 413 and body["offset"] == 0
+    upload = file_upload.load_pending_upload(video_id)
+    assert os.path.getsize(file_upload.pending_upload_path(video_id, upload)) == 0
+
+
+@pytest.mark.parametrize("width, height, rotation, heights", [
+    (640, 360, 0, [240, 360]),
+    (1066, 600, 0, [240, 480, 600]),
+    (1280, 720, 0, [240, 480, 720]),
+    (3840, 2160, 0, [240, 480, 720, 1080]),
+    (320, 181, 0, [180]),
+    (1920, 1080, 90, [240, 480, 720, 1080]),
+])
+def test_hls_ladder_tops_out_at_source_height(width, height, rotation, heights):
+    metadata = video_metadata.VideoMetadata(10, width, height, 30, 1000, rotation, "h264", "aac", [])
+    assert [rendition[0] for rendition in file_upload.hls_renditions(metadata)] == heights
+
+
+def test_shared_asset_reference_is_dropped_with_failed_insert(app, monkeypatch):
+    file_upload.db.session.execute(text("CREATE TABLE video_assets (hash text PRIMARY KEY, folder text, refcount integer)"))
+    file_upload.db.session.execute(text("INSERT INTO video_assets VALUES ('hash', 'shared', 1)"))
+    file_upload.db.session.commit()
+    # the videos table here has no content_hash column, so the insert fails
+    metadata = video_metadata.VideoMetadata(10, 640, 360, 30, 1000, 0, "h264", "aac", [])
+
+    with pytest.raises(Exception):
+        file_upload.start_transcode(1, "new", "original.mp4", "title", metadata, "hash")
+
+    assert file_upload.db.session.execute(text("SELECT refcount FROM video_assets")).scalar() == 1
@@ -0,0 +1,17 @@
+import os
+import pytest
+
+
+# the plans come from postgres, so this runs against the database in SQLALCHEMY_DATABASE_URI (with the schema loaded)
+pytestmark = pytest.mark.skipif(not (os.environ.get("SQLALCHEMY_DATABASE_URI") or "").startswith("postgresql"),
+                                reason="needs SQLALCHEMY_DATABASE_URI pointing to a postgres database")
+
+
+def test_hot_queries_use_indexes():
+    from app import app
+    from src import migrations
+
+    with app.app_context():
+        scans = { name: tables for name, tables in migrations.check_indexes().items() if tables }
+
+    assert not scans, f"sequential scans: {scans}"
@@ -0,0 +1,67 @@
+from types import SimpleNamespace
+import pytest
+from sqlalchemy import create_engine, event, text
+from src import migrations
+
+
+def test_split_statements_splits_on_semicolons_at_line_end():
+    sql = """-- no transaction
+-- the index is dropped first
+DROP INDEX IF EXISTS a_idx;
+CREATE INDEX a_idx ON a (x);
+
+SELECT ';' AS semicolon;
+-- nothing after this
+"""
+    assert migrations.split_statements(sql) == [
+        "-- no transaction\n-- the index is dropped first\nDROP INDEX IF EXISTS a_idx",
+        "CREATE INDEX a_idx ON a (x)",
+        "SELECT ';' AS semicolon",
+    ]
+
+
+def test_split_statements_drops_comment_only_parts():
+    assert migrations.split_statements("-- only a comment\n") == []
+    assert migrations.split_statements("SELECT 1;\n-- trailing;\n") == ["SELECT 1"]
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+
+    # the migrations name the "public" schema, which sqlite gets as an attached database
+    @event.listens_for(engine, "connect")
+    def attach_public(connection, _):
+        connection.execute(f"ATTACH DATABASE '{tmp_path / 'public.db'}' AS public")
+
+    folder = tmp_path / "migrations"
+    folder.mkdir()
+    monkeypatch.setattr(migrations, "db", SimpleNamespace(engine=engine))
+    monkeypatch.setattr(migrations, "MIGRATIONS_FOLDER", str(folder))
+    return engine, folder
+
+
+def test_migrate_applies_each_migration_once(database):
+    engine, folder = database
+    (folder / "0001_table.sql").write_text("CREATE TABLE public.items (x integer)")
+    (folder / "0002_rows.sql").write_text("""-- no transaction
+CREATE INDEX public.items_x_idx ON items (x);
+INSERT INTO public.items VALUES (1);
+INSERT INTO public.items VALUES (2);
+""")
+    (folder / "notes.txt").write_text("not a migration")
+
+    assert migrations.migrate() == ["0001_table.sql", "0002_rows.sql"]
+    assert migrations.migrate() == []
+    with engine.connect() as connection:
+        assert connection.execute(text("SELECT count(*) FROM public.items")).scalar() == 2
+    assert migrations.applied_versions() == { "0001", "0002" }
+
+
+def test_failed_migration_is_not_recorded(database):
+    engine, folder = database
+    (folder / "0001_broken.sql").write_text("CREATE TABLE public.items (x integer")
+
+    with pytest.raises(Exception):
+        migrations.migrate()
+    assert migrations.applied_versions() == set()
@@ -0,0 +1,28 @@
+from datetime import datetime
+from src import videos
+
+
+def test_cursor_round_trip():
+    upload_date = datetime(2024, 5, 6, 7, 8, 9, 123456)
+    cursor = videos.encode_cursor(upload_date, "abc-_")
+    assert videos.decode_cursor(cursor) == (upload_date, "abc-_")
+
+
+def test_invalid_cursor_is_none():
+    assert videos.decode_cursor("not a cursor") is None
+    assert videos.decode_cursor(videos.encode_cursor(datetime(2024, 1, 1), "a")[:-4]) is None
+    assert videos.decode_cursor("WzEsMiwzXQ==") is None  # [1,2,3]
+
+
+def test_paginate_returns_cursor_of_last_video_on_page():
+    page = [{ "id": str(i), "upload_date": datetime(2024, 1, 10 - i) } for i in range(3)]
+    result = videos.paginate(page, 2)
+
+    assert [video["id"] for video in result["videos"]] == ["0", "1"]
+    assert "upload_date" not in result["videos"][0]
+    assert videos.decode_cursor(result["next_cursor"]) == (datetime(2024, 1, 9), "1")
+
+
+def test_last_page_has_no_cursor():
+    result = videos.paginate([{ "id": "a", "upload_date": datetime(2024, 1, 1) }], 2)
+    assert result["next_cursor"] is None
@@ -0,0 +1,57 @@
+import os
+import pytest
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import text
+from src import file_upload, transcode_queue, video_metadata, worker
+from src.config import TRANSCODE_MAX_ATTEMPTS
+
+
+@pytest.fixture
+def app(monkeypatch):
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+    db = SQLAlchemy(app)
+    monkeypatch.setattr(file_upload, "db", db)
+    monkeypatch.setattr(video_metadata, "db", db)
+    with app.app_context():
+        db.session.execute(text("""CREATE TABLE videos (id text PRIMARY KEY, owner integer, title text, duration real,
+                                private boolean, folder text, content_hash text)"""))
+        db.session.execute(text("""CREATE TABLE video_metadata (video_id text PRIMARY KEY, width integer, height integer,
+                                frame_rate real, duration real, bitrate integer, rotation integer, video_codec text,
+                                audio_codec text, streams text)"""))
+        yield app
+
+
+def queue_job(video_id: str):
+    os.makedirs(os.path.join(file_upload.VIDEO_FOLDER, video_id))
+    metadata = video_metadata.VideoMetadata(10, 640, 360, 30, 1000, 0, "h264", "aac", [])
+    transcode_queue.enqueue(transcode_queue.TranscodeJob(video_id, 1, "title", "original.mp4", metadata))
+
+
+def test_failure_after_video_is_saved_keeps_the_video(app, monkeypatch):
+    transcoded = []
+    monkeypatch.setattr(file_upload, "transcode", transcoded.append)
+    # saving the final progress fails every time, after the video is in the database
+    monkeypatch.setattr(file_upload, "save_transcode_progress", lambda *args, **kwargs: 1 / 0)
+    queue_job("keepme")
+
+    for _ in range(TRANSCODE_MAX_ATTEMPTS):
+        worker.process_job(app, transcode_queue.dequeue(0))
+
+    assert transcode_queue.dequeue(0) is None
+    assert len(transcoded) == 1
+    assert file_upload.video_exists("keepme")
+    assert os.path.exists(os.path.join(file_upload.VIDEO_FOLDER, "keepme"))
+
+
+def test_failed_transcode_is_removed(app, monkeypatch):
+    monkeypatch.setattr(file_upload, "transcode", lambda job: 1 / 0)
+    monkeypatch.setattr(file_upload, "sleep", lambda seconds: None)
+    queue_job("failme")
+
+    for _ in range(TRANSCODE_MAX_ATTEMPTS):
+        worker.process_job(app, transcode_queue.dequeue(0))
+
+    assert transcode_queue.dequeue(0) is None
+    assert not os.path.exists(os.path.join(file_upload.VIDEO_FOLDER, "failme"))